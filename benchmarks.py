@@ -0,0 +1,125 @@
+"""
+Rough timings of common operations.  Run with ``make bench``.
+
+    python benchmarks.py [number of objects]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import persistent
+import persistent.storage
+
+
+# The most milliseconds ``import persistent`` may take, and the
+# dependencies it must leave to be imported on first use.
+
+IMPORT_BUDGET_MS = 100
+LAZY_IMPORTS = ('jsonpickle', 'ujson', 'keypath', 'isodatetimehandler',
+                'numpy', 'concurrent.futures')
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import persistent
+print((time.perf_counter() - start) * 1000)
+print(' '.join(name for name in %r if name in sys.modules))
+""" % (LAZY_IMPORTS,)
+
+
+class Item(persistent.Persistent):
+    pass
+
+
+def timed(label, fn, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('  %-40s %8.2f ms' % (label, best * 1000))
+
+
+def populate(n):
+    with persistent.transaction():
+        for i in range(n):
+            item = Item()
+            item.n = i
+            item.price = (i * 7919) % 1000 / 10.0
+            item.name = 'item %d' % i
+            item.tags = ['tag%d' % (i % 10), 'tag%d' % (i % 7)]
+            item.details = dict(color='red' if i % 2 else 'blue', size=i % 5)
+            item.save(use_transaction=False)
+
+
+def bench_import(repeat=5):
+    best = None
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT],
+                                check=True, capture_output=True,
+                                text=True).stdout.split('\n')
+        elapsed = float(output[0])
+        best = elapsed if best is None else min(best, elapsed)
+
+    print('import persistent:')
+    print('  %-40s %8.2f ms (budget %d ms)' % ('import', best,
+                                               IMPORT_BUDGET_MS))
+
+    eager = output[1].split()
+    if eager:
+        sys.exit('imported eagerly: %s' % ', '.join(eager))
+    if best > IMPORT_BUDGET_MS:
+        sys.exit('import took longer than %d ms' % IMPORT_BUDGET_MS)
+
+
+def bench_queries(storage, n):
+    fd, path = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+
+    try:
+        persistent.connect(db_path=path, storage=storage)
+        print('%s storage (%s), %d objects:' % (
+            storage,
+            'jsonb' if persistent.storage.use_jsonb else 'text',
+            n))
+
+        timed('insert', lambda: populate(n), repeat=1)
+
+        timed('count equal_to',
+              lambda: persistent.Query(Item)
+                  .equal_to('details.color', 'red').count())
+
+        def range_sorted():
+            q = persistent.Query(Item)
+            q.greater_than('price', 50)
+            q.descending('price')
+            q.limit(100)
+            q.find()
+
+        timed('greater_than + sort + limit 100', range_sorted)
+
+        timed('find_columns price, n',
+              lambda: persistent.Query(Item).find_columns('price', 'n'))
+    finally:
+        os.remove(path)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    bench_import()
+    bench_queries('text', n)
+
+    if persistent.storage.JSONB_SUPPORTED:
+        bench_queries('jsonb', n)
+    else:
+        print('jsonb storage: not supported by SQLite %s' %
+              persistent.storage.sqlite3.sqlite_version)
+
+
+if __name__ == '__main__':
+    main()
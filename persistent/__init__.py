@@ -1,6 +1,13 @@
 from .persistent import Persistent
-from .errors import UniquenessError, NotFoundError
-from .database import get, connect, add_index, transaction
+from .errors import UniquenessError, NotFoundError, ConflictError
+from .errors import ReferencedError
+from .database import get, connect, add_index, transaction, migrate_storage
+from .database import cache_stats, query_cache_stats, referrers
 from .query import Query, OrQuery
-
-import isodatetimehandler
+from .index import Index
+from .reference import Reference
+from .columns import Columns
+from .changes import Change, changes_since, truncate_changes
+from .warmup import warm
+from .timeseries import partitions, drop_partitions
+from .ids import time_ordered_id, time_id, id_time
@@ -0,0 +1,102 @@
+"""
+Command line tools for a database of persistent objects:
+
+    python -m persistent export DB [--class CLS ...] [-o FILE]
+    python -m persistent import DB [FILE] [--batch-size N]
+    python -m persistent backup DB DEST [--pages N]
+
+Each command also takes ``--shards N`` to open a database sharded over
+N files, and ``--storage jsonb`` to store imported objects as JSONB.
+"""
+
+import argparse
+import sys
+
+from . import database
+from . import tools
+
+
+def _report(message):
+    sys.stderr.write('\r%s' % message)
+    sys.stderr.flush()
+
+
+def _export(args):
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        n = tools.export_jsonl(
+            out, args.classes,
+            progress=lambda n: _report('exported %d objects' % n))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    _report('exported %d objects\n' % n)
+
+
+def _import(args):
+    lines = open(args.input) if args.input else sys.stdin
+    try:
+        n = tools.import_jsonl(
+            lines, batch_size=args.batch_size,
+            progress=lambda n: _report('imported %d objects' % n))
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    _report('imported %d objects\n' % n)
+
+
+def _backup(args):
+    def progress(remaining, total):
+        _report('backed up %d of %d pages' % (total - remaining, total))
+
+    tools.backup(args.dest, pages=args.pages, progress=progress)
+    _report('backup complete\n')
+
+
+def _add_database_arguments(command):
+    command.add_argument('db')
+    command.add_argument('--shards', type=int, default=1,
+                         help='number of shard files (default: 1)')
+    command.add_argument('--storage', choices=('text', 'jsonb'),
+                         default='text',
+                         help='how objects are stored (default: text)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m persistent')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    command = commands.add_parser(
+        'export', help='write objects to a JSON lines file')
+    _add_database_arguments(command)
+    command.add_argument('--class', dest='classes', action='append',
+                         metavar='CLS',
+                         help='qualified class name (may be repeated)')
+    command.add_argument('-o', '--output', help='file (default: stdout)')
+    command.set_defaults(run=_export)
+
+    command = commands.add_parser(
+        'import', help='insert objects from a JSON lines file')
+    _add_database_arguments(command)
+    command.add_argument('input', nargs='?', help='file (default: stdin)')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(run=_import)
+
+    command = commands.add_parser(
+        'backup', help='copy the database while it is in use')
+    _add_database_arguments(command)
+    command.add_argument('dest')
+    command.add_argument('--pages', type=int, default=1024,
+                         help='pages to copy per step')
+    command.set_defaults(run=_backup)
+
+    args = parser.parse_args(argv)
+
+    database.connect(db_path=args.db, shards=args.shards,
+                     storage=args.storage)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .util import qualified_class_name
+
+
+def _class_name(cls):
+    if isinstance(cls, str):
+        return cls
+    return qualified_class_name(cls)
+
+
+class _Entry:
+    __slots__ = ('value', 'weight', 'class_name', 'expires')
+
+    def __init__(self, value, weight, class_name, expires):
+        self.value = value
+        self.weight = weight
+        self.class_name = class_name
+        self.expires = expires
+
+
+class ObjectCache:
+    """
+    A cache of loaded objects by id whose entries each have a weight,
+    such as the length of the object's JSON, and whose total weight is
+    bounded by ``capacity``.  On a miss, ``load(key)`` is called which
+    must return the value and its weight.
+
+    With the ``'lru'`` policy the least recently used entries are
+    evicted first.  With the scan resistant ``'slru'`` (segmented LRU)
+    policy, new entries are put on probation and only entries used
+    again are protected; entries on probation are evicted first so a
+    scan of many objects used once does not evict those used often.
+
+    Entries expire ``ttl`` seconds after being cached, if given.
+    ``quotas`` maps classes (or qualified class names) to the most
+    total weight the cache may hold of objects of that class.
+
+    The cache may be used from several threads.
+    """
+
+    def __init__(self, capacity, load,
+                 policy='lru',
+                 ttl=None,
+                 quotas=None,
+                 protected_ratio=0.8):
+
+        if policy not in ('lru', 'slru'):
+            raise ValueError('cache policy must be "lru" or "slru"')
+
+        self.capacity = capacity
+        self.policy = policy
+        self.ttl = ttl
+        self.quotas = dict((_class_name(cls), quota)
+                           for cls, quota in (quotas or {}).items())
+        self._load = load
+        self._protected_capacity = (capacity * protected_ratio
+                                    if policy == 'slru' else 0)
+        self._entries = {}
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._protected_weight = 0
+        self._class_keys = {}
+        self._class_weights = {}
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if (entry is not None and entry.expires is not None and
+                    entry.expires <= time.monotonic()):
+                self._remove(key)
+                entry = None
+
+            if entry is not None:
+                self.hits += 1
+                self._touch(key, entry)
+                return entry.value
+
+            self.misses += 1
+
+        value, weight = self._load(key)
+        self.set(key, value, weight)
+        return value
+
+
+    def set(self, key, value, weight=1):
+        """
+        Cache ``value`` as ``key`` unless it weighs more than the
+        capacity (or its class's quota) allows.
+        """
+
+        class_name = _class_name(value.__class__)
+        quota = self.quotas.get(class_name)
+        expires = time.monotonic() + self.ttl if self.ttl else None
+
+        with self._lock:
+            self.pop(key)
+
+            if weight > self.capacity or (quota is not None and
+                                          weight > quota):
+                return
+
+            self._entries[key] = _Entry(value, weight, class_name, expires)
+            self._probation[key] = None
+            self.weight += weight
+
+            if quota is not None:
+                keys = self._class_keys.setdefault(class_name, OrderedDict())
+                keys[key] = None
+                self._class_weights[class_name] = (
+                    self._class_weights.get(class_name, 0) + weight)
+
+                while self._class_weights[class_name] > quota:
+                    self._remove(next(iter(keys)))
+
+            while self.weight > self.capacity:
+                segment = self._probation or self._protected
+                self._remove(next(iter(segment)))
+
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            self._remove(key)
+            return entry.value
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._probation.clear()
+            self._protected.clear()
+            self._protected_weight = 0
+            self._class_keys.clear()
+            self._class_weights.clear()
+            self.weight = 0
+
+
+    def hottest(self):
+        """
+        The cached keys, most recently used (and protected) first.
+        """
+
+        with self._lock:
+            return (list(reversed(self._protected)) +
+                    list(reversed(self._probation)))
+
+
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    size=len(self._entries),
+                    weight=self.weight)
+
+
+    def _touch(self, key, entry):
+        keys = self._class_keys.get(entry.class_name)
+        if keys is not None:
+            keys.move_to_end(key)
+
+        if key in self._protected:
+            self._protected.move_to_end(key)
+            return
+
+        if self.policy == 'lru':
+            self._probation.move_to_end(key)
+            return
+
+        # Used again while on probation so protect it, moving the
+        # least recently used protected entries back to probation.
+
+        del self._probation[key]
+        self._protected[key] = None
+        self._protected_weight += entry.weight
+
+        while (self._protected_weight > self._protected_capacity and
+               len(self._protected) > 1):
+            demoted = next(iter(self._protected))
+            del self._protected[demoted]
+            self._protected_weight -= self._entries[demoted].weight
+            self._probation[demoted] = None
+
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.weight -= entry.weight
+
+        if key in self._protected:
+            del self._protected[key]
+            self._protected_weight -= entry.weight
+        else:
+            del self._probation[key]
+
+        keys = self._class_keys.get(entry.class_name)
+        if keys is not None:
+            del keys[key]
+            self._class_weights[entry.class_name] -= entry.weight
@@ -0,0 +1,101 @@
+from collections import namedtuple
+from datetime import datetime
+
+from . import database
+from .util import qualified_class_name
+
+
+Change = namedtuple('Change', 'seq id cls op version timestamp')
+
+
+def record(connection, obj, op, version, timestamp=None):
+    """
+    Append a change of ``obj`` to the change log of the shard at
+    ``connection``.  Call in the same transaction as the change.
+    """
+
+    timestamp = timestamp or datetime.utcnow()
+
+    connection.execute(
+        "INSERT INTO changes (id, class, op, version, timestamp) "
+        "VALUES (?, ?, ?, ?, ?)", (
+            obj.id,
+            qualified_class_name(obj.__class__),
+            op,
+            version,
+            timestamp.isoformat()))
+
+
+def record_deletes(connection, cls, versions, timestamp=None):
+    """
+    Append the deletion of objects of ``cls`` to the change log of
+    the shard at ``connection``, given ``(id, version)`` pairs of
+    their versions after deletion.
+    """
+
+    timestamp = (timestamp or datetime.utcnow()).isoformat()
+    class_name = qualified_class_name(cls)
+
+    connection.executemany(
+        "INSERT INTO changes (id, class, op, version, timestamp) "
+        "VALUES (?, ?, 'delete', ?, ?)",
+        [(object_id, class_name, version, timestamp)
+         for object_id, version in versions])
+
+
+def record_inserts(connection, rowid, timestamp=None):
+    """
+    Append the insertion of the objects stored after ``rowid``, such
+    as those inserted directly by an import, to the change log of the
+    shard at ``connection``, each at its stored version.
+    """
+
+    connection.execute(
+        "INSERT INTO changes (id, class, op, version, timestamp) "
+        "SELECT json_extract(json, '$.id'), "
+        "json_extract(json, '$.py/object'), 'insert', "
+        "coalesce(json_extract(json, '$._version'), 0), ? "
+        "FROM objects WHERE rowid > ? ORDER BY rowid",
+        ((timestamp or datetime.utcnow()).isoformat(), rowid))
+
+
+def changes_since(seq=0, limit=None, shard=0, batch_size=1000):
+    """
+    Iterate over the changes recorded after sequence number ``seq``
+    in order.  Each is a ``Change`` whose ``op`` is one of ``insert``,
+    ``update`` or ``delete`` and whose ``version`` is the object's
+    ``_version`` after the change.  Remember the ``seq`` of the last change
+    processed to resume from there later.
+
+    Each shard has its own change log; ``shard`` selects which.
+    """
+
+    connection = database.connections[shard]
+    sql = ("SELECT seq, id, class, op, version, timestamp FROM changes "
+           "WHERE seq > ? ORDER BY seq LIMIT ?")
+
+    remaining = limit
+    while remaining is None or remaining > 0:
+        n = batch_size if remaining is None else min(batch_size, remaining)
+        rows = connection.execute(sql, (seq, n)).fetchall()
+
+        for row in rows:
+            yield Change(*row)
+
+        if len(rows) < n:
+            return
+
+        seq = rows[-1][0]
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+def truncate_changes(before_seq, shard=0):
+    """
+    Discard the changes with a sequence number less than ``before_seq``,
+    e.g. once all consumers have processed them.
+    """
+
+    connection = database.connections[shard]
+    with connection:
+        connection.execute("DELETE FROM changes WHERE seq < ?", (before_seq,))
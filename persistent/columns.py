@@ -0,0 +1,172 @@
+from array import array
+import itertools
+
+# NumPy, imported on first use as it is slow to import; None if it
+# is not installed.
+
+numpy = False
+
+
+def _numpy():
+    global numpy
+
+    if numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+
+    return numpy
+
+
+class _ColumnBuilder:
+    """
+    Accumulates the values of one column, as a packed integer array
+    while all values are integers, then as a packed float array while
+    all values are numbers, then as a plain list.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = array('q')
+
+
+    def append(self, value):
+        values = self.values
+
+        if type(values) is list:
+            values.append(value)
+            return
+
+        if values.typecode == 'q' and type(value) is int:
+            try:
+                values.append(value)
+                return
+            except OverflowError:
+                pass
+
+        if type(value) in (int, float):
+            if values.typecode == 'q':
+                values = self.values = array('d', values)
+            values.append(value)
+            return
+
+        values = self.values = list(values)
+        values.append(value)
+
+
+    def finish(self):
+        if type(self.values) is array and _numpy() is not None:
+            return numpy.frombuffer(self.values, dtype=self.values.typecode)
+        return self.values
+
+
+class Columns:
+    """
+    Query results as one sequence per key path rather than one object
+    per row.  Numeric columns are packed ``array.array`` instances or
+    NumPy arrays when NumPy is installed; other columns are lists.
+    Missing values are ``None``.
+    """
+
+    __slots__ = ('key_paths', '_columns', '_length')
+
+    def __init__(self, key_paths, rows):
+        builders = [_ColumnBuilder() for key_path in key_paths]
+        length = 0
+
+        for row in rows:
+            for builder, value in zip(builders, row):
+                builder.append(value)
+            length += 1
+
+        self.key_paths = tuple(key_paths)
+        self._columns = dict(zip(self.key_paths,
+                                 [builder.finish() for builder in builders]))
+        self._length = length
+
+
+    def __getitem__(self, key_path):
+        return self._columns[key_path]
+
+
+    def __contains__(self, key_path):
+        return key_path in self._columns
+
+
+    def __iter__(self):
+        return iter(self.key_paths)
+
+
+    def __len__(self):
+        return self._length
+
+
+    def keys(self):
+        return self.key_paths
+
+
+    def items(self):
+        return [(key_path, self._columns[key_path])
+                for key_path in self.key_paths]
+
+
+    def rows(self):
+        """
+        Iterate over the results as tuples of values.
+        """
+
+        return zip(*[self._columns[key_path] for key_path in self.key_paths])
+
+
+def _missing(dtype):
+    # What to store for missing values: NaN (from None) for
+    # floating point and complex numbers.
+
+    if dtype.kind in 'fc':
+        return None
+    if dtype.kind in 'US':
+        return ''
+    if dtype.kind == 'b':
+        return False
+    return 0
+
+
+def to_arrays(fields, rows, size, chunk_size=10000):
+    """
+    Read ``rows`` of the values of ``fields``, a dict of key paths to
+    NumPy dtypes, ``chunk_size`` rows at a time into NumPy arrays
+    allocated for ``size`` rows, and return the arrays by key path.
+    """
+
+    if _numpy() is None:
+        raise ImportError('NumPy is required for NumPy arrays')
+
+    dtypes = [numpy.dtype(dtype) for dtype in fields.values()]
+    missing = [_missing(dtype) for dtype in dtypes]
+    arrays = [numpy.empty(size, dtype=dtype) for dtype in dtypes]
+
+    rows = iter(rows)
+    n = 0
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        end = n + len(chunk)
+        if end > len(arrays[0]):
+            arrays = [numpy.resize(values, max(end, 2 * len(values)))
+                      for values in arrays]
+
+        for values, column, fill in zip(arrays, zip(*chunk), missing):
+            if fill is not None and None in column:
+                column = [fill if value is None else value
+                          for value in column]
+            values[n:end] = column
+
+        n = end
+
+    return dict(zip(fields, [values[:n] for values in arrays]))
@@ -0,0 +1,42 @@
+from .util import qualified_class_name
+
+
+def record(connection, cls, delta):
+    """
+    Add ``delta`` to the number of objects of ``cls`` stored on the
+    shard at ``connection``.  Call in the same transaction as the
+    insert or delete.
+    """
+
+    connection.execute(
+        "INSERT INTO class_counts (class, n) VALUES (?, ?) "
+        "ON CONFLICT (class) DO UPDATE SET n = n + excluded.n",
+        (qualified_class_name(cls), delta))
+
+
+def rebuild(connection):
+    """
+    Recount the objects of each class stored on the shard at
+    ``connection``, e.g. after inserting objects directly.
+    """
+
+    connection.execute("DELETE FROM class_counts")
+    connection.execute(
+        "INSERT INTO class_counts (class, n) "
+        "SELECT json_extract(json, '$.py/object'), count(*) FROM objects "
+        "GROUP BY 1")
+
+
+def class_count(cls, shard):
+    """
+    The number of objects of ``cls`` (or of any class, if ``None``)
+    stored on ``shard``.
+    """
+
+    if cls is None:
+        row = shard.execute("SELECT sum(n) FROM class_counts").fetchone()
+    else:
+        row = shard.execute("SELECT n FROM class_counts WHERE class=?",
+                            (qualified_class_name(cls),)).fetchone()
+
+    return (row[0] or 0) if row else 0
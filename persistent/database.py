@@ -1,19 +1,36 @@
 import sqlite3
-from datetime import datetime
-import copy
 import re
 import logging
-
-import shortuuid
-import jsonpickle
-from cachetools import LRUCache
+import atexit
+import os
+import zlib
 
 from .errors import NotFoundError
+from .reference import Reference
+from . import storage as _storage
+from .cache import ObjectCache
+from .results import ResultCache
+from . import counts as _counts
+from . import index as _index
+from .ids import time_ordered_id
+from .util import qualified_class_name
 
 
 logger = logging.getLogger(__name__)
 connection = None
+connections = []
+sharded_by = 'id'
+executor = None
 objects = None
+cache_by_bytes = False
+hot_ids_file = None
+results = None
+index_builder = None
+ensured_classes = set()
+use_lazy_references = False
+check_coherence = False
+generate_id = time_ordered_id
+_coherence = {}
 
 
 def _log_sql(sql):
@@ -23,10 +40,173 @@ def _log_sql(sql):
 def connect(db_path=':memory:',
             debug=False,
             cache_size=1000,
-            use_WAL=True):
+            cache_bytes=None,
+            cache_ttl=None,
+            cache_quotas=None,
+            cache_policy='lru',
+            use_WAL=True,
+            lazy_references=False,
+            shards=1,
+            shard_by='id',
+            coherent_cache=False,
+            storage='text',
+            hot_ids_path=None,
+            query_cache_size=0,
+            reconcile_indexes=True,
+            background_index_rows=100000,
+            id_generator=None):
+    """
+    With ``shards`` > 1, objects are spread over that many database
+    files named ``db_path`` suffixed with ``.0``, ``.1``, etc.  Objects
+    are routed to a shard by a hash of their ``id``, or of their class
+    name if ``shard_by`` is ``'class'``.
+
+    With ``coherent_cache``, objects changed by other processes are
+    evicted from the object cache before it is used.
+
+    With ``storage='jsonb'``, objects are stored in SQLite's binary
+    JSON format if supported (SQLite 3.45.0+), else as JSON text.
+
+    The object cache holds up to ``cache_size`` objects, or if given,
+    objects whose JSON totals up to ``cache_bytes`` bytes.  Cached
+    objects expire after ``cache_ttl`` seconds, if given.
+    ``cache_quotas`` maps classes to the most objects (or bytes) of
+    each the cache may hold.  ``cache_policy='slru'`` keeps objects
+    used more than once cached in favor of those loaded by a scan.
+
+    With ``hot_ids_path``, the ids of the cached objects are written to
+    that file at exit, most recently used first, and the objects are
+    loaded into the cache when next connecting.
+
+    With ``query_cache_size`` > 0, the ids of the objects found by up
+    to that many queries are cached until an object of the query's
+    class is saved or deleted.
+
+    With ``reconcile_indexes``, the indexes declared by persistent
+    classes are created if missing and dropped if no longer declared.
+    Those of classes with more than ``background_index_rows`` objects
+    are created in the background by the thread ``index_builder``.
+
+    New objects are given ids by calling ``id_generator``, by default
+    ``time_ordered_id``.
+    """
+
+    if shard_by not in ('id', 'class'):
+        raise ValueError('shard_by must be "id" or "class"')
+
+    if storage not in ('text', 'jsonb'):
+        raise ValueError('storage must be "text" or "jsonb"')
+
+    # Registers the jsonpickle handler storing datetimes as ISO 8601
+    # strings; deferred to here as importing jsonpickle is slow.
+
+    import isodatetimehandler
+
+    _storage.use_jsonb = storage == 'jsonb' and _storage.JSONB_SUPPORTED
+    if storage == 'jsonb' and not _storage.use_jsonb:
+        logger.warning('SQLite %s does not support JSONB; storing JSON text',
+                       sqlite3.sqlite_version)
+
+    global connection, connections, executor
+    if executor is not None:
+        executor.shutdown()
+        executor = None
+
+    if shards > 1:
+        paths = [db_path if db_path == ':memory:' else '%s.%d' % (db_path, i)
+                 for i in range(shards)]
+        connections = [_open(path, debug, use_WAL, check_same_thread=False)
+                       for path in paths]
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=shards)
+    else:
+        connections = [_open(db_path, debug, use_WAL)]
+
+    connection = connections[0]
+
+    global sharded_by
+    sharded_by = shard_by
+
+    global objects, cache_by_bytes
+    cache_by_bytes = cache_bytes is not None
+    objects = ObjectCache(cache_bytes if cache_by_bytes else cache_size,
+                          load=_load,
+                          policy=cache_policy,
+                          ttl=cache_ttl,
+                          quotas=cache_quotas)
+
+    global results
+    results = ResultCache(query_cache_size) if query_cache_size > 0 else None
+
+    ensured_classes.clear()
+
+    global use_lazy_references
+    use_lazy_references = lazy_references
+
+    global check_coherence
+    check_coherence = coherent_cache
+
+    global generate_id
+    generate_id = id_generator or time_ordered_id
+
+    _coherence.clear()
+    for shard in connections:
+        _coherence[shard] = [
+            shard.execute("PRAGMA data_version").fetchone()[0],
+            shard.execute("SELECT coalesce(max(seq), 0) FROM changes")
+                 .fetchone()[0]]
+
+    global index_builder
+    index_builder = None
+    if reconcile_indexes:
+        index_builder = _index.reconcile_indexes(background_index_rows)
+
+    global hot_ids_file
+    hot_ids_file = hot_ids_path
+    if hot_ids_path is not None:
+        atexit.unregister(save_hot_ids)
+        atexit.register(save_hot_ids)
+        if os.path.exists(hot_ids_path):
+            load_hot_ids(hot_ids_path)
+
+
+def save_hot_ids(path=None):
+    """
+    Write the ids of the cached objects, most recently used first,
+    to ``path`` (by default, the ``hot_ids_path`` given to ``connect``).
+    """
+
+    path = path or hot_ids_file
+    if path is None or objects is None:
+        return
+
+    with open(path, 'w') as f:
+        for object_id in objects.hottest():
+            f.write(object_id)
+            f.write('\n')
+
+
+def load_hot_ids(path, chunk_size=500):
+    """
+    Load the objects whose ids were written to ``path`` by
+    ``save_hot_ids`` into the cache, as many as fit.
+    """
+
+    with open(path) as f:
+        ids = [line.strip() for line in f if line.strip()]
+
+    ids = ids[:objects.capacity] if not cache_by_bytes else ids
+    ids.reverse()   # so the hottest are cached last
+
+    for i in range(0, len(ids), chunk_size):
+        get_many(ids[i:i + chunk_size])
 
-    global connection
-    connection = sqlite3.connect(db_path)
+
+def _open(db_path, debug, use_WAL, check_same_thread=True):
+    connection = sqlite3.connect(db_path,
+                                 check_same_thread=check_same_thread)
+    connection.create_function('inflate', 1, _storage.inflate,
+                               deterministic=True)
 
     if debug:
         connection.set_trace_callback(_log_sql)
@@ -34,22 +214,169 @@ def connect(db_path=':memory:',
     if use_WAL:
         connection.execute("PRAGMA journal_type = WAL")
 
+    has_counts = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='class_counts'").fetchone()
+
     connection.executescript("""
 PRAGMA case_sensitive_like = ON;
-CREATE TABLE IF NOT EXISTS objects (json JSON NOT NULL);
+CREATE TABLE IF NOT EXISTS objects (json JSON NOT NULL, payload BLOB);
 CREATE UNIQUE INDEX IF NOT EXISTS id_index ON objects (json_extract(json, '$.id'));
 CREATE INDEX IF NOT EXISTS type_index ON objects (json_extract(json, '$.py/object'));
+CREATE TABLE IF NOT EXISTS object_elements (
+  object INTEGER NOT NULL,
+  key_path TEXT NOT NULL,
+  value,
+  PRIMARY KEY (key_path, value, object)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS element_object_index ON object_elements (object);
+CREATE TABLE IF NOT EXISTS element_indexes (
+  class TEXT NOT NULL,
+  key_path TEXT NOT NULL,
+  PRIMARY KEY (class, key_path));
+CREATE TABLE IF NOT EXISTS changes (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  id TEXT NOT NULL,
+  class TEXT NOT NULL,
+  op TEXT NOT NULL,
+  version INTEGER NOT NULL,
+  timestamp TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS change_id_index ON changes (id, version);
+CREATE TABLE IF NOT EXISTS object_references (
+  target TEXT NOT NULL,
+  attr TEXT NOT NULL,
+  source TEXT NOT NULL,
+  PRIMARY KEY (target, attr, source)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS reference_source_index ON object_references (source);
+CREATE TABLE IF NOT EXISTS reference_indexes (
+  class TEXT NOT NULL,
+  attr TEXT NOT NULL,
+  PRIMARY KEY (class, attr));
+CREATE TABLE IF NOT EXISTS class_counts (
+  class TEXT PRIMARY KEY,
+  n INTEGER NOT NULL);
 """)
 
-    global objects
-    objects = LRUCache(maxsize=cache_size,
-                       missing=get)
+    # Databases created before class counts were kept need counting.
+
+    if not has_counts:
+        with connection:
+            _counts.rebuild(connection)
+
+    # Databases created before compressed storage lack the payload column.
+
+    columns = [row[1] for row in connection.execute(
+        "PRAGMA table_xinfo(objects)")]
+    if 'payload' not in columns:
+        connection.execute("ALTER TABLE objects ADD COLUMN payload BLOB")
+
+    return connection
+
+
+def _shard_index(key):
+    return zlib.crc32(key.encode('utf-8')) % len(connections)
+
+
+def shard_for(obj):
+    """
+    The connection to the database shard storing ``obj``.
+    """
+
+    if len(connections) == 1:
+        return connection
+
+    if sharded_by == 'class':
+        return connections[_shard_index(qualified_class_name(obj.__class__))]
+
+    return connections[_shard_index(obj.id)]
+
+
+def shard_for_class(cls):
+    """
+    The connection to the only shard that can store objects of
+    ``cls``, or ``None`` if objects of any class may be on any shard.
+    """
+
+    if len(connections) == 1:
+        return connection
+
+    if sharded_by == 'class' and cls is not None:
+        return connections[_shard_index(qualified_class_name(cls))]
+
+    return None
+
+
+def _shards_for_id(object_id):
+    if len(connections) == 1 or sharded_by == 'class':
+        return connections
+    return [connections[_shard_index(object_id)]]
+
+
+def map_shards(fn, shards=None):
+    """
+    Call ``fn`` with the connection to each shard (in parallel if
+    there is more than one) and return the results in shard order.
+    """
+
+    shards = connections if shards is None else shards
+    if len(shards) == 1:
+        return [fn(shards[0])]
+    return list(executor.map(fn, shards))
+
+
+def cached(object_id):
+    """
+    The object with the given id from the object cache,
+    loaded from the database on a cache miss.
+    """
 
+    if check_coherence:
+        invalidate_changed()
 
-def unpickle(text):
+    return objects[object_id]
+
+
+def invalidate_changed():
+    """
+    Evict from the object cache the objects changed by other
+    connections, e.g. in other processes, since last checked.
+    """
+
+    for shard in connections:
+        state = _coherence[shard]
+
+        # data_version changes only when another connection commits.
+
+        data_version = shard.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == state[0]:
+            continue
+        state[0] = data_version
+
+        rows = shard.execute(
+            "SELECT seq, id, class FROM changes WHERE seq > ? ORDER BY seq",
+            (state[1],)).fetchall()
+        if not rows:
+            continue
+
+        if rows[0][0] != state[1] + 1:
+            objects.clear()   # the log was truncated past what we had seen
+            if results is not None:
+                results.clear()
+        else:
+            for seq, object_id, class_name in rows:
+                objects.pop(object_id, None)
+                invalidate_results(class_name)
+
+        state[1] = rows[-1][0]
+
+
+def unpickle(text, lazy=None):
+    import jsonpickle
     obj = jsonpickle.decode(text)
 
-    # Convert references back to loaded objects.
+    if lazy is None:
+        lazy = use_lazy_references
+
+    # Convert references back to loaded objects, or to
+    # proxies that load them on first use.
 
     refs = obj.__class__.references
     try:
@@ -57,56 +384,253 @@ def unpickle(text):
         for attr in refs:
             ref_id = getattr(obj, attr, None)
             if type(ref_id) is str:
-                setattr(obj, attr, objects[ref_id])
+                if lazy:
+                    setattr(obj, attr, Reference(ref_id))
+                else:
+                    setattr(obj, attr, cached(ref_id))
     except TypeError as err:
         pass
 
     return obj
 
 
-def get(object_id):
-    sql = "SELECT json FROM objects WHERE json_extract(json, '$.id')=?"
+def _weight(text):
+    return len(text) if cache_by_bytes else 1
+
+
+def _load(object_id):
+    text = _fetch(object_id)
+    obj = unpickle(text)
+    obj.mark_clean()
+    return obj, _weight(text)
+
+
+def _fetch(object_id):
+    sql = ("SELECT %s FROM objects WHERE json_extract(json, '$.id')=?" %
+           _storage.object_sql())
 
-    row = connection.execute(sql, (object_id,)).fetchone()
-    if not row:
-        raise NotFoundError('object not found: %s' % object_id)
+    for shard in _shards_for_id(object_id):
+        row = shard.execute(sql, (object_id,)).fetchone()
+        if row:
+            return row[0]
 
-    obj = unpickle(row[0])
+    raise NotFoundError('object not found: %s' % object_id)
+
+
+def get(object_id):
+    obj = unpickle(_fetch(object_id))
     obj.mark_clean()
     return obj
 
 
+def invalidate_results(cls):
+    """
+    Forget the cached results of queries of ``cls`` (a class or
+    qualified class name), if queries are cached.
+    """
+
+    if results is None:
+        return
+
+    if not isinstance(cls, str):
+        cls = qualified_class_name(cls)
+
+    results.invalidate(cls)
+
+
+def query_cache_stats():
+    """
+    The query result cache's hits, misses, size and hit rate, or
+    ``None`` if queries are not cached.
+    """
+
+    return None if results is None else results.stats()
+
+
+def cache_stats():
+    """
+    The object cache's hits, misses, size (number of objects) and
+    weight (number of objects, or bytes with ``cache_bytes``).
+    """
+
+    return objects.stats()
+
+
+def get_many(object_ids, lazy=None):
+    """
+    Load the objects with the given ids in as few queries as possible
+    and place them in the object cache.  Returns a dict of the objects
+    found by id.  ``lazy`` overrides ``lazy_references`` if given.
+    """
+
+    by_shard = {}
+    for object_id in set(object_ids):
+        for shard in _shards_for_id(object_id):
+            by_shard.setdefault(shard, []).append(object_id)
+
+    def load(shard):
+        ids = by_shard.get(shard, [])
+        rows = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            sql = ("SELECT %s FROM objects WHERE json_extract(json, '$.id') "
+                   "IN (%s)" % (_storage.object_sql(),
+                                ','.join(['?'] * len(chunk))))
+            rows.extend(shard.execute(sql, chunk).fetchall())
+        return rows
+
+    found = {}
+
+    for rows in map_shards(load):
+        for row in rows:
+            obj = unpickle(row[0], lazy=lazy)
+            obj.mark_clean()
+            found[obj.id] = obj
+            objects.set(obj.id, obj, _weight(row[0]))
+
+    return found
+
+
+def referrer_edges(object_id, attr=None):
+    """
+    The ``(source id, attribute)`` of each reference to the object
+    with the given id (through ``attr`` only, if given).
+    """
+
+    sql = "SELECT source, attr FROM object_references WHERE target=?"
+    values = [object_id]
+    if attr is not None:
+        sql += " AND attr=?"
+        values.append(attr)
+
+    edges = []
+    for rows in map_shards(lambda shard: shard.execute(sql, values)
+                                              .fetchall()):
+        edges.extend(rows)
+    return edges
+
+
+def referrers(obj, attr=None):
+    """
+    The objects which reference ``obj`` (or the object with that id)
+    through their class's ``references`` (or only through ``attr``).
+    """
+
+    object_id = getattr(obj, 'id', obj)
+    source_ids = sorted(set(source for source, attr
+                            in referrer_edges(object_id, attr)))
+    found = get_many(source_ids)
+    return [found[source] for source in source_ids if source in found]
+
+
+def migrate_storage(storage, batch_size=10000):
+    """
+    Convert all stored objects to ``storage`` (``'text'`` or ``'jsonb'``)
+    in batches of ``batch_size`` objects per transaction.  Objects
+    are read whichever way they are stored; connect with the same
+    ``storage`` afterwards to save objects that way too.
+    """
+
+    if storage == 'jsonb':
+        if not _storage.JSONB_SUPPORTED:
+            raise ValueError('SQLite %s does not support JSONB' %
+                             sqlite3.sqlite_version)
+        function = 'jsonb'
+    elif storage == 'text':
+        function = 'json'
+    else:
+        raise ValueError('storage must be "text" or "jsonb"')
+
+    for shard in connections:
+        last = 0
+        while True:
+            with shard:
+                row = shard.execute(
+                    "SELECT max(rowid) FROM (SELECT rowid FROM objects "
+                    "WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                    (last, batch_size)).fetchone()
+                if row[0] is None:
+                    break
+
+                shard.execute(
+                    "UPDATE objects SET json=%s(json) "
+                    "WHERE rowid > ? AND rowid <= ?" % function,
+                    (last, row[0]))
+                last = row[0]
+
+    _storage.use_jsonb = storage == 'jsonb'
+
+
 def index_name(key_paths):
     return '%s__idx' % re.subn(r'[./]', '_', '__'.join(key_paths))[0]
 
 
 def add_index(key_paths,
               unique=False,
-              global_scope=False):
-
-    # Global scope means all objects regardless of their class type.
-
-    if not global_scope:
-        index_parts = ["json_extract(json, '$.py/object')"]
+              global_scope=False,
+              cls=None,
+              where=None):
+    """
+    Index the values at ``key_paths`` and return the index's name.
+    With ``cls``, the index is a partial index of only the objects
+    of ``cls`` matching ``where`` (see ``Index``), named after the
+    class too.
+    """
+
+    index_parts = []
+    where_sql = ''
+
+    if cls is not None:
+        where_sql = ' WHERE %s' % _index.partial_sql(cls, where)
+    elif not global_scope:
+        # Global scope means all objects regardless of their class type.
+        index_parts.append("json_extract(json, '$.py/object')")
 
     index_parts.extend(["json_extract(json, '$.%s')" % key_path
         for key_path in key_paths])
 
     name = index_name(key_paths)
+    if cls is not None:
+        name = '%s__%s' % (name, re.subn(r'[./]', '_',
+                                         qualified_class_name(cls))[0])
 
-    sql = "CREATE %s INDEX IF NOT EXISTS '%s' ON objects (%s)" % (
+    sql = "CREATE %s INDEX IF NOT EXISTS '%s' ON objects (%s)%s" % (
         'UNIQUE' if unique else '',
         name,
-        ', '.join(index_parts)
+        ', '.join(index_parts),
+        where_sql
     )
 
-    connection.execute(sql)
+    for shard in connections:
+        shard.execute(sql)
 
     return name
 
 
+class _ShardedTransaction:
+    """
+    Commits (or on error rolls back) each shard in turn.  This is
+    not atomic across shards.
+    """
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for shard in connections:
+            if exc_type is None:
+                shard.commit()
+            else:
+                shard.rollback()
+        return False
+
+
 def transaction():
     """ Use this as a context manager to save/delete a
     bunch of persistent objects in a single transaction """
 
-    return connection
+    if len(connections) == 1:
+        return connection
+
+    return _ShardedTransaction()
@@ -5,3 +5,31 @@ class UniquenessError(ValueError):
 
 class NotFoundError(KeyError):
     pass
+
+
+class ConflictError(RuntimeError):
+    """
+    Raised on saving an object that was changed or deleted
+    (by another process, or through another copy of the object)
+    since it was loaded.
+    """
+
+    def __init__(self, object_id, version):
+        RuntimeError.__init__(
+            self, 'object %s is no longer at version %s' % (object_id, version))
+        self.object_id = object_id
+        self.version = version
+
+
+class ReferencedError(ValueError):
+    """
+    Raised on deleting an object still referenced by an object
+    whose class declares ``on_delete`` of ``'restrict'`` for the
+    referencing attribute.
+    """
+
+    def __init__(self, object_id, referrer_id):
+        ValueError.__init__(
+            self, 'object %s is referenced by %s' % (object_id, referrer_id))
+        self.object_id = object_id
+        self.referrer_id = referrer_id
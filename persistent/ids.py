@@ -0,0 +1,82 @@
+import base64
+import random as _random
+import threading
+import time
+
+from .index import to_epoch
+
+
+# Crockford's base 32 alphabet, whose characters sort in the same order
+# as the values they encode.
+
+_ALPHABET = b'0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_CROCKFORD = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', _ALPHABET)
+
+_RANDOM_BITS = 80
+_RANDOM_MAX = (1 << _RANDOM_BITS) - 1
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+
+def _encode(ms, random):
+    # 26 characters of 5 bits: 2 zero bits, then the 48 bit time in
+    # milliseconds, then the 80 random bits.  Shifted so b32encode,
+    # which encodes 5 bit groups from the left, starts at the zero bits.
+
+    value = (ms << _RANDOM_BITS | random) << 6
+    return base64.b32encode(value.to_bytes(17, 'big'))[:26] \
+        .translate(_CROCKFORD).decode('ascii')
+
+
+def time_ordered_id():
+    """
+    A new id of 26 characters which sorts after all ids generated
+    before it by this process, as a ULID: the time in milliseconds
+    followed by 80 bits, random for the first id generated in a
+    millisecond and incremented for the others.  New objects' ids
+    thus append to the end of the id index.
+    """
+
+    global _last_ms, _last_random
+
+    ms = time.time_ns() // 1000000
+
+    with _lock:
+        if ms <= _last_ms:
+            ms = _last_ms
+            random = _last_random + 1
+            if random > _RANDOM_MAX:
+                ms += 1
+                random = _random.getrandbits(_RANDOM_BITS - 1)
+        else:
+            # Leave room to increment within the millisecond.
+            random = _random.getrandbits(_RANDOM_BITS - 1)
+
+        _last_ms = ms
+        _last_random = random
+
+    return _encode(ms, random)
+
+
+def time_id(when):
+    """
+    The lowest time ordered id generated at the ``datetime`` ``when``
+    (naive datetimes are taken to be in UTC) for comparing ids, e.g.
+    ``Query(Item).greater_than_or_equal_to('id', time_id(since))``.
+    """
+
+    return _encode(int(to_epoch(when) * 1000), 0)
+
+
+def id_time(object_id):
+    """
+    The time, as seconds since the UNIX epoch, at which the time
+    ordered id ``object_id`` was generated.
+    """
+
+    ms = 0
+    for c in object_id[:10].upper().encode('ascii'):
+        ms = ms * 32 + _ALPHABET.index(c)
+    return ms / 1000
@@ -0,0 +1,644 @@
+import re
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from . import database
+from . import counts
+from .util import qualified_class_name
+
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime(1970, 1, 1)
+
+# Persistent classes by qualified name, whose indexes are
+# reconciled on connecting.
+
+registered_classes = {}
+
+_affinities = {
+    int: 'INTEGER',
+    bool: 'INTEGER',
+    float: 'REAL',
+    str: 'TEXT',
+    datetime: 'REAL',
+}
+
+
+def _sanitize(name):
+    return re.subn(r'[./]', '_', name)[0]
+
+
+def to_epoch(value):
+    """
+    Seconds since the UNIX epoch for a ``datetime``.
+    Naive datetimes are taken to be in UTC.
+    """
+
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH).total_seconds()
+
+
+class Index:
+    """
+    A typed index on a key path declared by a persistent class:
+
+        class Item(Persistent):
+            indexes = [Index('price', type=float),
+                       Index('created_at', type=datetime)]
+
+    The value at ``key_path`` is extracted into a generated column of
+    the given type and that column is indexed.  Datetimes are stored as
+    seconds since the UNIX epoch.
+
+    With ``multi_value=True`` each element of the list at ``key_path``
+    is indexed instead, for use by ``Query.has_element`` and
+    ``Query.has_any``.
+
+    Only objects of the declaring class are indexed, and if given,
+    only those matching ``where``: a dict of key paths to the values
+    they must equal, or an SQL expression.
+    """
+
+    def __init__(self, key_path, type=str, unique=False, multi_value=False,
+                 where=None):
+        if type not in _affinities:
+            raise ValueError('unsupported index type: %r' % type)
+
+        if unique and multi_value:
+            raise ValueError('a multi-value index cannot be unique')
+
+        if where and multi_value:
+            raise ValueError('a multi-value index cannot be partial')
+
+        self.key_path = key_path
+        self.type = type
+        self.unique = unique
+        self.multi_value = multi_value
+        self.where = where
+
+
+    def name(self, cls):
+        """
+        The name of the SQLite index of this index declared by ``cls``.
+        """
+
+        return '%s__%s__idx' % (_sanitize(qualified_class_name(cls)),
+                                self.column)
+
+
+    @property
+    def column(self):
+        # Datetime columns were once computed with julianday(), which
+        # keeps only milliseconds; the new name replaces those columns.
+
+        if self.type is datetime:
+            return '%s__epoch' % _sanitize(self.key_path)
+        return '%s__%s' % (_sanitize(self.key_path), self.type.__name__)
+
+
+    @property
+    def column_sql(self):
+        if self.type is datetime:
+            # Whole microseconds divided once by a million, as is done
+            # by ``to_epoch``, so both give exactly the same float.
+
+            iso = "json_extract(json, '$.%s.iso')" % self.key_path
+            return ("(CAST(strftime('%%s', %s) AS INTEGER) * 1000000 + "
+                    "CASE WHEN substr(%s, 20, 1) = '.' "
+                    "THEN CAST(substr(%s, 21, 6) AS INTEGER) ELSE 0 END"
+                    ") / 1000000.0" % (iso, iso, iso))
+
+        return "CAST(json_extract(json, '$.%s') AS %s)" % (
+            self.key_path, _affinities[self.type])
+
+
+    def to_column_value(self, value):
+        """
+        Convert a query operand to the column's representation.
+        """
+
+        if isinstance(value, datetime):
+            return to_epoch(value)
+        return value
+
+
+def declared_indexes(cls):
+    try:
+        indexes = list(cls.indexes)
+    except (AttributeError, TypeError):
+        indexes = []
+
+    # The time key of a time series is indexed as a datetime.
+
+    key_path = getattr(cls, 'time_series', None)
+    if key_path and not any(index.key_path == key_path and
+                            not index.multi_value for index in indexes):
+        indexes.append(Index(key_path, type=datetime))
+
+    return indexes
+
+
+def typed_index(cls, key_path):
+    """
+    The declared ``Index`` of ``cls`` on ``key_path``, if any.
+    """
+
+    if cls is None:
+        return None
+
+    for index in declared_indexes(cls):
+        if index.key_path == key_path and not index.multi_value:
+            return index
+
+    return None
+
+
+def element_index(cls, key_path):
+    """
+    The declared multi-value ``Index`` of ``cls`` on ``key_path``, if any.
+    """
+
+    if cls is None:
+        return None
+
+    for index in declared_indexes(cls):
+        if index.key_path == key_path and index.multi_value:
+            return index
+
+    return None
+
+
+def declared_full_text(cls):
+    try:
+        return list(cls.full_text)
+    except (AttributeError, TypeError):
+        return []
+
+
+def full_text_table(cls):
+    return '%s__fts' % _sanitize(qualified_class_name(cls))
+
+
+def _columns(connection):
+    rows = connection.execute("PRAGMA table_xinfo(objects)")
+    return set(row[1] for row in rows)
+
+
+def ensure_indexes(cls):
+    """
+    Create the generated columns and indexes declared by ``cls``
+    if they do not yet exist.  Done once per class per connection.
+    """
+
+    if cls in database.ensured_classes:
+        return
+
+    for connection in database.connections:
+        _ensure_indexes(cls, connection)
+
+    database.ensured_classes.add(cls)
+
+
+def declared_unique_together(cls):
+    try:
+        return [list(key_paths) for key_paths in cls.unique_together]
+    except (AttributeError, TypeError):
+        return []
+
+
+def _literal(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'%s'" % value.replace("'", "''")
+    raise ValueError('unsupported partial index value: %r' % (value,))
+
+
+def partial_sql(cls, where=None, unary_class=False):
+    """
+    The WHERE clause of a partial index of only the objects of
+    ``cls`` which match ``where`` (see ``Index``).
+
+    With ``unary_class``, the class is compared as ``+json_extract(...)``
+    which the index of objects by class cannot serve.  Queries using a
+    typed index compare the class so too, so that SQLite uses the typed
+    index rather than the index by class without statistics from ANALYZE.
+    """
+
+    clauses = ["%sjson_extract(json, '$.py/object')=%s" % (
+        '+' if unary_class else '', _literal(qualified_class_name(cls)))]
+
+    if isinstance(where, dict):
+        clauses.extend("json_extract(json, '$.%s')=%s" % (key_path,
+                                                           _literal(value))
+                       for key_path, value in sorted(where.items()))
+    elif where:
+        clauses.append('(%s)' % where)
+
+    return ' AND '.join(clauses)
+
+
+def index_statements(cls):
+    """
+    The name and SQL of each index of the ``objects`` table
+    declared by ``cls``, in ``indexes`` or ``unique_together``.
+    These are partial indexes of only the objects of ``cls``.
+    """
+
+    prefix = _sanitize(qualified_class_name(cls))
+    statements = []
+
+    for index in declared_indexes(cls):
+        if not index.multi_value:
+            name = index.name(cls)
+            statements.append((name,
+                "CREATE %s INDEX IF NOT EXISTS '%s' "
+                "ON objects (\"%s\") WHERE %s" % (
+                    'UNIQUE' if index.unique else '',
+                    name,
+                    index.column,
+                    partial_sql(cls, index.where,
+                                unary_class=not isinstance(index.where,
+                                                           str)))))
+
+    for key_paths in declared_unique_together(cls):
+        name = '%s__%s__uniq' % (prefix, _sanitize('__'.join(key_paths)))
+        statements.append((name,
+            "CREATE UNIQUE INDEX IF NOT EXISTS '%s' "
+            "ON objects (%s) WHERE %s" % (
+                name,
+                ', '.join("json_extract(json, '$.%s')" % key_path
+                          for key_path in key_paths),
+                partial_sql(cls))))
+
+    return statements
+
+
+def _definition(sql):
+    # Whether an index is unique and what it indexes,
+    # ignoring how the CREATE INDEX statement was written.
+
+    head, _, tail = sql.partition(' ON objects ')
+    return 'UNIQUE' in head.upper(), tail.strip()
+
+
+def _ensure_indexes(cls, connection, create_indexes=True):
+    existing = None
+
+    for index in declared_indexes(cls):
+        if index.multi_value:
+            _ensure_elements(cls, index, connection)
+            continue
+
+        if existing is None:
+            existing = _columns(connection)
+
+        if index.column not in existing:
+            connection.execute(
+                'ALTER TABLE objects ADD COLUMN "%s" %s '
+                'GENERATED ALWAYS AS (%s) VIRTUAL' % (
+                    index.column,
+                    _affinities[index.type],
+                    index.column_sql))
+            existing.add(index.column)
+
+    if create_indexes:
+        for name, sql in index_statements(cls):
+            connection.execute(sql)
+
+    fields = declared_full_text(cls)
+    if fields:
+        _ensure_full_text(cls, fields, connection)
+
+    for attr in cls.references or []:
+        _ensure_references(cls, attr, connection)
+
+
+def register(cls):
+    """
+    Add ``cls`` to the classes whose declared indexes are created,
+    and those no longer declared dropped, on connecting.
+    """
+
+    registered_classes[qualified_class_name(cls)] = cls
+
+
+def reconcile_indexes(background_rows=None):
+    """
+    Create the missing indexes declared by the registered classes,
+    drop the indexes they no longer declare, then ``ANALYZE`` the
+    indexes created.  The full-text index of a class is rebuilt if its
+    fields changed.
+
+    The indexes of classes with more than ``background_rows`` stored
+    objects in a database file are created in a thread, over a
+    connection of its own, which is returned if started.  Until
+    then queries do not use them and unique indexes are not enforced.
+    Each ``CREATE INDEX`` holds the write lock of its database file
+    until built, so saving meanwhile may fail with "database is locked".
+    """
+
+    deferred = []
+
+    for connection in database.connections:
+        existing = dict(connection.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type='index' "
+            "AND tbl_name='objects'").fetchall())
+        path = connection.execute('PRAGMA database_list').fetchone()[2]
+        pending = []
+        created = []
+
+        with connection:
+            for class_name, cls in sorted(registered_classes.items()):
+                statements = index_statements(cls)
+                declared = set(name for name, sql in statements)
+                missing = []
+
+                for name, sql in statements:
+                    if name not in existing:
+                        missing.append((name, sql))
+                    elif _definition(existing[name]) != _definition(sql):
+                        connection.execute('DROP INDEX "%s"' % name)
+                        missing.append((name, sql))
+
+                prefix = _sanitize(class_name) + '__'
+                for name in existing:
+                    if (name.startswith(prefix) and name not in declared and
+                            name.endswith(('__idx', '__uniq'))):
+                        connection.execute('DROP INDEX "%s"' % name)
+
+                if not declared_full_text(cls):
+                    connection.execute('DROP TABLE IF EXISTS "%s"' %
+                                       full_text_table(cls))
+
+                in_background = (missing and path and
+                                 background_rows is not None and
+                                 counts.class_count(cls, connection) >
+                                 background_rows)
+
+                _ensure_indexes(cls, connection,
+                                create_indexes=not in_background)
+
+                if in_background:
+                    pending.extend(missing)
+                else:
+                    created.extend(name for name, sql in missing)
+
+        # Dropping an index deletes its statistics, so only those of
+        # the indexes created need gathering.
+
+        for name in created:
+            connection.execute('ANALYZE "%s"' % name)
+
+        if pending:
+            deferred.append((path, pending))
+
+    database.ensured_classes.update(registered_classes.values())
+
+    if not deferred:
+        return None
+
+    def build():
+        for path, statements in deferred:
+            connection = sqlite3.connect(path, timeout=60)
+            try:
+                for name, sql in statements:
+                    with connection:
+                        connection.execute(sql)
+                    connection.execute('ANALYZE "%s"' % name)
+            except sqlite3.DatabaseError:
+                logger.exception('failed to create indexes in %s', path)
+            finally:
+                connection.close()
+
+    thread = threading.Thread(target=build, name='persistent-indexes',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def _ensure_elements(cls, index, connection):
+    class_name = qualified_class_name(cls)
+
+    exists = connection.execute(
+        "SELECT 1 FROM element_indexes WHERE class=? AND key_path=?",
+        (class_name, index.key_path)).fetchone()
+    if exists:
+        return
+
+    # Index objects saved before the class declared the index.
+
+    _fill_elements(class_name, index.key_path, connection)
+
+    connection.execute(
+        "INSERT INTO element_indexes VALUES (?, ?)",
+        (class_name, index.key_path))
+
+
+def _fill_elements(class_name, key_path, connection):
+    connection.execute(
+        "INSERT OR IGNORE INTO object_elements "
+        "SELECT objects.rowid, ?, element.value "
+        "FROM objects, json_each(objects.json, '$.%s') AS element "
+        "WHERE json_extract(objects.json, '$.py/object')=?" % key_path,
+        (key_path, class_name))
+
+
+def _sync_elements(obj, connection):
+    indexes = [index for index in declared_indexes(obj.__class__)
+               if index.multi_value]
+    if not indexes:
+        return
+
+    _delete_elements(obj, connection)
+
+    for index in indexes:
+        connection.execute(
+            "INSERT OR IGNORE INTO object_elements "
+            "SELECT objects.rowid, ?, element.value "
+            "FROM objects, json_each(objects.json, '$.%s') AS element "
+            "WHERE json_extract(objects.json, '$.id')=?" % index.key_path,
+            (index.key_path, obj.id))
+
+
+def _delete_elements(obj, connection):
+    if not any(index.multi_value
+               for index in declared_indexes(obj.__class__)):
+        return
+
+    connection.execute(
+        "DELETE FROM object_elements WHERE object = (SELECT rowid "
+        "FROM objects WHERE json_extract(json, '$.id')=?)", (obj.id,))
+
+
+def _ensure_references(cls, attr, connection):
+    class_name = qualified_class_name(cls)
+
+    exists = connection.execute(
+        "SELECT 1 FROM reference_indexes WHERE class=? AND attr=?",
+        (class_name, attr)).fetchone()
+    if exists:
+        return
+
+    # Index references of objects saved before they were indexed.
+
+    _fill_references(class_name, attr, connection)
+
+    connection.execute(
+        "INSERT INTO reference_indexes VALUES (?, ?)", (class_name, attr))
+
+
+def _fill_references(class_name, attr, connection):
+    connection.execute(
+        "INSERT OR IGNORE INTO object_references (target, attr, source) "
+        "SELECT json_extract(json, '$.%s'), ?, json_extract(json, '$.id') "
+        "FROM objects WHERE json_extract(json, '$.py/object')=? "
+        "AND json_type(json, '$.%s')='text'" % (attr, attr),
+        (attr, class_name))
+
+
+def _sync_references(obj, connection):
+    attrs = obj.__class__.references
+    if not attrs:
+        return
+
+    _delete_references(obj, connection)
+
+    # References have been replaced by the referenced objects' ids.
+
+    connection.executemany(
+        "INSERT OR IGNORE INTO object_references (target, attr, source) "
+        "VALUES (?, ?, ?)",
+        [(getattr(obj, attr), attr, obj.id) for attr in attrs
+         if type(getattr(obj, attr, None)) is str])
+
+
+def _delete_references(obj, connection):
+    if not obj.__class__.references:
+        return
+
+    connection.execute("DELETE FROM object_references WHERE source=?",
+                       (obj.id,))
+
+
+def rebuild_indexes(cls):
+    """
+    Rebuild the index tables of ``cls`` from its stored objects,
+    e.g. after objects were inserted other than by saving them.
+    """
+
+    ensure_indexes(cls)
+
+    class_name = qualified_class_name(cls)
+    element_key_paths = [index.key_path for index in declared_indexes(cls)
+                         if index.multi_value]
+    fields = declared_full_text(cls)
+
+    for connection in database.connections:
+        for key_path in element_key_paths:
+            connection.execute(
+                "DELETE FROM object_elements WHERE key_path=? AND object IN "
+                "(SELECT rowid FROM objects "
+                "WHERE json_extract(json, '$.py/object')=?)",
+                (key_path, class_name))
+            _fill_elements(class_name, key_path, connection)
+
+        if fields:
+            connection.execute('DELETE FROM "%s"' % full_text_table(cls))
+            _fill_full_text(cls, fields, connection)
+
+        for attr in cls.references or []:
+            connection.execute(
+                "DELETE FROM object_references WHERE attr=? AND source IN "
+                "(SELECT json_extract(json, '$.id') FROM objects "
+                "WHERE json_extract(json, '$.py/object')=?)",
+                (attr, class_name))
+            _fill_references(class_name, attr, connection)
+
+
+def sync_indexes(obj, connection):
+    """
+    Update the index tables maintained for a just saved object.
+    """
+
+    _sync_full_text(obj, connection)
+    _sync_elements(obj, connection)
+    _sync_references(obj, connection)
+
+
+def delete_indexes(obj, connection):
+    """
+    Remove the index table entries of an object about to be deleted.
+    """
+
+    _delete_full_text(obj, connection)
+    _delete_elements(obj, connection)
+    _delete_references(obj, connection)
+
+
+def _full_text_select(fields):
+    return ', '.join("json_extract(json, '$.%s')" % field for field in fields)
+
+
+def _ensure_full_text(cls, fields, connection):
+    table = full_text_table(cls)
+
+    columns = [row[1] for row in connection.execute(
+        'PRAGMA table_info("%s")' % table)]
+    if columns == fields:
+        return
+
+    # The class's full-text fields changed: index them anew.
+
+    if columns:
+        connection.execute('DROP TABLE "%s"' % table)
+
+    connection.execute(
+        'CREATE VIRTUAL TABLE "%s" USING fts5(%s)' % (
+            table, ', '.join('"%s"' % field for field in fields)))
+
+    # Index objects saved before the class declared its full-text fields.
+
+    _fill_full_text(cls, fields, connection)
+
+
+def _fill_full_text(cls, fields, connection):
+    connection.execute(
+        'INSERT INTO "%s" (rowid, %s) SELECT rowid, %s FROM objects '
+        "WHERE json_extract(json, '$.py/object')=?" % (
+            full_text_table(cls),
+            ', '.join('"%s"' % field for field in fields),
+            _full_text_select(fields)),
+        (qualified_class_name(cls),))
+
+
+def _sync_full_text(obj, connection):
+    fields = declared_full_text(obj.__class__)
+    if not fields:
+        return
+
+    _delete_full_text(obj, connection)
+
+    connection.execute(
+        'INSERT INTO "%s" (rowid, %s) SELECT rowid, %s FROM objects '
+        "WHERE json_extract(json, '$.id')=?" % (
+            full_text_table(obj.__class__),
+            ', '.join('"%s"' % field for field in fields),
+            _full_text_select(fields)),
+        (obj.id,))
+
+
+def _delete_full_text(obj, connection):
+    if not declared_full_text(obj.__class__):
+        return
+
+    connection.execute(
+        'DELETE FROM "%s" WHERE rowid = (SELECT rowid FROM objects '
+        "WHERE json_extract(json, '$.id')=?)" % full_text_table(obj.__class__),
+        (obj.id,))
@@ -3,18 +3,25 @@ from datetime import datetime
 import sqlite3
 import re
 
-import shortuuid
-import jsonpickle
-
-from .errors import UniquenessError, NotFoundError
+from .errors import UniquenessError, ConflictError, ReferencedError
 from . import database
+from .index import ensure_indexes, sync_indexes, delete_indexes, register
+from .reference import Reference
+from . import changes
+from . import counts
+from . import storage
 
 
 class Persistent:
     """ See README """
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        register(cls)
+
+
     def __init__(self):
-        self.id = shortuuid.uuid()
+        self.id = database.generate_id()
 
 
     def __setattr__(self, key, value):
@@ -43,7 +50,24 @@ class Persistent:
         return not hasattr(self, 'created_at')
 
 
+    @property
+    def persistent_version(self):
+        """
+        The number of times this object has been saved, named so as
+        not to hide an attribute ``version`` of the object.
+        """
+
+        return self.__dict__.get('_version', 0)
+
+
     references = None
+    indexes = None
+    full_text = None
+    compress = False
+    queryable = None
+    on_delete = None
+    unique_together = None
+    time_series = None
 
 
     def _with_references(self):
@@ -66,6 +90,8 @@ class Persistent:
                     if referenced.is_new:
                         referenced.save(False)
                     setattr(obj, attr, referenced.id)
+                elif isinstance(referenced, Reference):
+                    setattr(obj, attr, referenced.id)
 
         return obj
 
@@ -75,38 +101,67 @@ class Persistent:
             return self
 
         if use_transaction:
-            with database.connection:
+            with database.transaction():
                 return self._save()
 
         return self._save()
 
 
     def _save(self):
+        ensure_indexes(self.__class__)
+
         to_save = self._with_references()
+        connection = database.shard_for(self)
 
         now = datetime.utcnow()
+        is_new = self.is_new
+        version = self.persistent_version + 1
+        stamps = dict((key, self.__dict__[key])
+                      for key in ('_version', 'created_at', 'updated_at')
+                      if key in self.__dict__)
 
-        try:
-            if self.is_new:
-                if self != to_save:
-                    to_save.created_at = now
+        # The stored copy may be this object itself.
+
+        to_save.__dict__['_version'] = version
 
+        try:
+            if is_new:
+                to_save.__dict__['created_at'] = now
                 to_save.mark_clean()
 
-                sql = "INSERT INTO objects VALUES (json(?))"
-                database.connection.execute(sql, (jsonpickle.encode(to_save),))
+                sql = ("INSERT INTO objects (json, payload) VALUES (%s, ?)" %
+                       storage.bind_sql())
+                connection.execute(sql, storage.encode(to_save))
+                counts.record(connection, self.__class__, 1)
             else:
-                if self != to_save:
-                    to_save.updated_at = now
-
+                to_save.__dict__['updated_at'] = now
                 to_save.mark_clean()
 
-                sql = "UPDATE objects SET json=json(?) WHERE json_extract(json, '$.id')=?"
-                database.connection.execute(sql, (
-                    jsonpickle.encode(to_save),
-                    to_save.id))
+                # Only update the object if it is still at the version
+                # it was loaded at; otherwise someone else changed it.
+
+                sql = ("UPDATE objects SET json=%s, payload=? "
+                       "WHERE json_extract(json, '$.id')=? "
+                       "AND coalesce(json_extract(json, '$._version'), 0)=?" %
+                       storage.bind_sql())
+                cursor = connection.execute(sql, storage.encode(to_save) + (
+                    to_save.id,
+                    version - 1))
+
+                if cursor.rowcount == 0:
+                    raise ConflictError(self.id, version - 1)
+
+            sync_indexes(to_save, connection)
+            changes.record(connection, to_save,
+                           'insert' if is_new else 'update',
+                           version, now)
+
+            database.objects.pop(self.id, None)
+            database.invalidate_results(self.__class__)
+
+            self.__dict__['_version'] = version
 
-            if self.is_new:
+            if is_new:
                 self.created_at = now
             else:
                 self.updated_at = now
@@ -115,9 +170,15 @@ class Persistent:
 
             return to_save
 
-        except sqlite3.DatabaseError as err:
+        except (sqlite3.DatabaseError, ConflictError) as err:
+            for key in ('_version', 'created_at', 'updated_at'):
+                self.__dict__.pop(key, None)
+            self.__dict__.update(stamps)
             self.mark_dirty()
 
+            if isinstance(err, ConflictError):
+                raise
+
             err = str(err)
             if 'UNIQUE' in err:
                 match = re.match(r"'([^']+)'", err)
@@ -128,10 +189,57 @@ class Persistent:
 
 
     def delete(self, use_transaction=True):
-        sql = "DELETE FROM objects WHERE json_extract(json, '$.id')=?"
-
         if use_transaction:
-            with database.connection:
-                database.connection.execute(sql, (self.id,))
+            with database.transaction():
+                self._delete()
         else:
-            database.connection.execute(sql, (self.id,))
+            self._delete()
+
+
+    def _delete(self):
+        ensure_indexes(self.__class__)
+
+        cascaded = self._referrers_to_cascade()
+
+        connection = database.shard_for(self)
+        delete_indexes(self, connection)
+
+        sql = "DELETE FROM objects WHERE json_extract(json, '$.id')=?"
+        if connection.execute(sql, (self.id,)).rowcount:
+            counts.record(connection, self.__class__, -1)
+            changes.record(connection, self, 'delete', self.persistent_version + 1)
+
+        database.objects.pop(self.id, None)
+        database.invalidate_results(self.__class__)
+
+        for referrer in cascaded:
+            referrer.delete(use_transaction=False)
+
+
+    def _referrers_to_cascade(self):
+        """
+        The objects referencing this one whose classes declare
+        ``on_delete`` of ``'cascade'`` for the referencing attribute.
+        Raises ``ReferencedError`` if any declare ``'restrict'``.
+        """
+
+        edges = [(source, attr) for source, attr
+                 in database.referrer_edges(self.id) if source != self.id]
+        if not edges:
+            return []
+
+        found = database.get_many(source for source, attr in edges)
+        cascaded = []
+
+        for source, attr in edges:
+            referrer = found.get(source)
+            if referrer is None:
+                continue
+
+            action = (referrer.on_delete or {}).get(attr)
+            if action == 'restrict':
+                raise ReferencedError(self.id, source)
+            if action == 'cascade':
+                cascaded.append(referrer)
+
+        return cascaded
@@ -1,19 +1,56 @@
 import re
+import heapq
+import random
+from collections import OrderedDict
+import itertools
 from datetime import datetime
 
-import ujson as json
-import keypath
-
 from . import database
+from . import counts
+from .util import qualified_class_name
 from .persistent import Persistent
+from .reference import Reference
+from .columns import Columns, to_arrays
+from .storage import object_sql
+from .index import typed_index, element_index, ensure_indexes, \
+    declared_full_text, full_text_table
+
+
+def _extract(key_path, table='objects'):
+    return "json_extract(%s.json, '$.%s')" % (table, key_path)
+
+
+def _sqlite_order(value):
+    # SQLite sorts NULLs first, then numbers, text and blobs.
+
+    if value is None:
+        return (0, 0)
+    if type(value) is str:
+        return (2, value)
+    if type(value) is bytes:
+        return (3, value)
+    return (1, value)
 
 
-def _extract(key_path):
-    return "json_extract(json, '$.%s')" % key_path
+class _SortKey:
+    """
+    Orders rows from different shards as an ORDER BY over
+    their trailing sort columns would.
+    """
+
+    __slots__ = ('values', 'orders')
 
+    def __init__(self, values, orders):
+        self.values = values
+        self.orders = orders
 
-def _qualified_class_name(cls):
-    return '%s.%s' % (cls.__module__, cls.__name__)
+
+    def __lt__(self, other):
+        for a, b, order in zip(self.values, other.values, self.orders):
+            a, b = _sqlite_order(a), _sqlite_order(b)
+            if a != b:
+                return a < b if order == 'ASC' else b < a
+        return False
 
 
 class Query:
@@ -27,9 +64,20 @@ class Query:
         self._limit = 0
         self._skip = 0
         self._where = []
+        self._filters = []
+        self._search = None
+        self._prefetch = []
+        self._include = None
+        self._joins = OrderedDict()
+        self._cls = cls
+        self._class_sql = None
         if cls:
-            self._add_condition('py/object', '=',
-                                _qualified_class_name(cls))
+            # The class name is not bound so that SQLite can tell that
+            # the class's partial indexes cover the objects queried.
+
+            self._class_sql = "%s = '%s'" % (
+                _extract('py/object'),
+                qualified_class_name(cls).replace("'", "''"))
 
 
     def _add_condition(self, key_path, operator,
@@ -98,7 +146,8 @@ class Query:
     def equal_to(self, key_path, value):
         value_transformer = None
         if type(value) in [tuple, list]:
-            value = json.dumps(value)
+            import ujson
+            value = ujson.dumps(value)
             value_transformer = 'json'
         return self._add_condition(key_path, '=', value, value_transformer)
 
@@ -106,7 +155,8 @@ class Query:
     def not_equal_to(self, key_path, value):
         value_transformer = None
         if type(value) in [tuple, list]:
-            value = json.dumps(value)
+            import ujson
+            value = ujson.dumps(value)
             value_transformer = 'json'
         return self._add_condition(key_path, '!=', value, value_transformer)
 
@@ -159,6 +209,49 @@ class Query:
         return self._add_condition(key_path, '<=', n, value_transformer)
 
 
+    def between(self, key_path, start, end):
+        """
+        The value at ``key_path`` is at least ``start`` and less than
+        ``end``, e.g. a datetime in a period of time.
+        """
+
+        self.greater_than_or_equal_to(key_path, start)
+        return self.less_than(key_path, end)
+
+
+    def has_element(self, key_path, value):
+        """
+        The list at ``key_path`` contains ``value``.
+        """
+
+        return self.has_any(key_path, [value])
+
+
+    def has_any(self, key_path, values):
+        """
+        The list at ``key_path`` contains any of ``values``.
+
+        Uses the class's multi-value ``Index`` on ``key_path`` if
+        declared, else scans the list of each object.
+        """
+
+        values = [value.id if isinstance(value, (Persistent, Reference))
+                  else value for value in values]
+        binds = ','.join(['?'] * len(values))
+
+        if element_index(self._cls, key_path) is not None:
+            ensure_indexes(self._cls)
+            sql = ('objects.rowid IN (SELECT object FROM object_elements '
+                   'WHERE key_path=? AND value IN (%s))' % binds)
+            self._filters.append((sql, [key_path] + values))
+        else:
+            sql = ("EXISTS (SELECT 1 FROM json_each(objects.json, '$.%s') "
+                   "WHERE value IN (%s))" % (key_path, binds))
+            self._filters.append((sql, values))
+
+        return self
+
+
     def matches(self, key_path, regex_pattern, case_insensitive=False):
         flags = re.IGNORECASE if case_insensitive else 0
         pattern = re.compile(regex_pattern, flags)
@@ -206,6 +299,131 @@ class Query:
         return self.not_contained_in(key_path, ids)
 
 
+    def search(self, text, fields=None):
+        """
+        Full-text search of the fields the query's class declares
+        in ``full_text`` (or only ``fields`` thereof) using the FTS5
+        query syntax.  Results are ordered by relevance after any
+        explicit sort order.
+        """
+
+        declared = declared_full_text(self._cls)
+        if not declared:
+            raise ValueError('query class declares no full_text fields')
+
+        if fields:
+            unknown = set(fields) - set(declared)
+            if unknown:
+                raise ValueError('not full_text fields: %s' %
+                                 ', '.join(sorted(unknown)))
+            text = '{%s} : (%s)' % (' '.join(fields), text)
+
+        ensure_indexes(self._cls)
+        self._search = (full_text_table(self._cls), text)
+        return self
+
+
+    def prefetch(self, *attrs):
+        """
+        Load the objects referenced by ``attrs`` of the objects found
+        with one query per attribute rather than one per object.
+        """
+
+        self._prefetch.extend(attrs)
+        return self
+
+
+    def include(self, *paths, depth=None):
+        """
+        Load the objects referenced along ``paths`` of reference
+        attributes, such as ``'author.company'``, of the objects found,
+        with one query per level of references rather than one per
+        object.  Without ``paths``, all references are followed.
+        At most ``depth`` levels are followed, by default as many as
+        the longest path or else one.
+        """
+
+        tree = None
+        if paths:
+            tree = {}
+            for path in paths:
+                node = tree
+                for attr in path.split('.'):
+                    node = node.setdefault(attr, {})
+
+        if depth is None:
+            depth = max([len(path.split('.')) for path in paths] or [1])
+
+        self._include = (tree, depth)
+        return self
+
+
+    def _load_included(self, objs):
+        # Load each level of references in one batch, binding
+        # or replacing the references to the loaded objects.
+
+        tree, depth = self._include
+        lazy = database.use_lazy_references
+        frontier = [(obj, tree) for obj in objs]
+        reached = list(objs)
+
+        for level in range(depth):
+            links = []
+            for obj, node in frontier:
+                if node is None:
+                    links.extend((obj, attr, None)
+                                 for attr in obj.__class__.references or [])
+                else:
+                    links.extend((obj, attr, node[attr]) for attr in node)
+
+            ids = set()
+            for obj, attr, node in links:
+                value = obj.__dict__.get(attr)
+                if isinstance(value, Reference) and not value.is_loaded:
+                    ids.add(value.id)
+
+            loaded = database.get_many(
+                [ref_id for ref_id in ids if ref_id not in database.objects],
+                lazy=True)
+
+            frontier = []
+            for obj, attr, node in links:
+                value = obj.__dict__.get(attr)
+
+                if isinstance(value, Persistent):
+                    target = value
+                elif isinstance(value, Reference):
+                    target = value._target or loaded.get(value.id)
+                    if target is None and value.id in database.objects:
+                        target = database.objects[value.id]
+                    if target is None:
+                        continue
+
+                    if lazy:
+                        value._bind(target)
+                    else:
+                        obj.__dict__[attr] = target
+                else:
+                    continue
+
+                reached.append(target)
+                if node is None or node:
+                    frontier.append((target, node))
+
+            if not frontier:
+                break
+
+        # Without lazy references, the references not included
+        # are loaded one by one as usual.
+
+        if not lazy:
+            for obj in reached:
+                for attr in obj.__class__.references or []:
+                    value = obj.__dict__.get(attr)
+                    if isinstance(value, Reference):
+                        obj.__dict__[attr] = value.resolve()
+
+
     def ascending(self, key_path):
         if self._sort is None:
             self._sort = []
@@ -236,17 +454,102 @@ class Query:
         return self
 
 
+    def _typed_index(self, key_path):
+        index = typed_index(self._cls, key_path)
+        if index is not None:
+            ensure_indexes(self._cls)
+        return index
+
+
+    def _uses_typed_index(self):
+        # Whether a key path compared or sorted on has a typed index
+        # whose partial index covers the objects queried.  Those with
+        # an SQL ``where`` are left to SQLite (see ``partial_sql``).
+
+        builder = database.index_builder
+        if builder is not None and builder.is_alive():
+            return False
+
+        key_paths = []
+        equal = {}
+
+        for key_path, operator, operand, bind_type, \
+            value_transformer in self._where:
+            if value_transformer is None:
+                key_paths.append(key_path)
+                if operator == '=':
+                    equal.setdefault(key_path, []).append(operand)
+
+        key_paths.extend(key_path for key_path, order in self._sort or [])
+
+        for key_path in key_paths:
+            index = self._typed_index(key_path)
+            if index is None or isinstance(index.where, str):
+                continue
+
+            if all(value in equal.get(where_key_path, []) and
+                   self._typed_index(where_key_path) is None
+                   for where_key_path, value in (index.where or {}).items()):
+                return True
+
+        return False
+
+
+    def _column_sql(self, key_path):
+        index = self._typed_index(key_path)
+        if index is not None:
+            return 'objects."%s"' % index.column
+        return self._join_extract(key_path)
+
+
+    def _join_extract(self, key_path):
+        """
+        SQL for the value at ``key_path``, which may follow references
+        to other objects with ``->`` as in ``'customer->address.country'``.
+        The referenced objects are joined to the query.
+        """
+
+        attrs = key_path.split('->')
+        table = 'objects'
+
+        for i, attr in enumerate(attrs[:-1]):
+            alias = '"ref:%s"' % '->'.join(attrs[:i + 1])
+            if alias not in self._joins:
+                self._joins[alias] = (
+                    "LEFT JOIN objects AS %s ON %s = %s" % (
+                        alias, _extract('id', alias), _extract(attr, table)))
+            table = alias
+
+        return _extract(attrs[-1], table)
+
+
     def _make_where_sql(self):
         values = []
         clauses = []
 
+        if self._class_sql:
+            # Compared as the typed index's partial index clause when
+            # using one so SQLite prefers it to the index by class.
+
+            clauses.append(('+' if self._uses_typed_index() else '') +
+                           self._class_sql)
+
         for key_path, operator, operand, bind_type, \
             value_transformer in self._where:
 
-            if isinstance(operand, datetime):
-                key_path += '.iso'
+            index = self._typed_index(key_path)
 
-            key_path = _extract(key_path)
+            if index is not None and value_transformer is None:
+                key_path = 'objects."%s"' % index.column
+                if type(operand) in [tuple, list]:
+                    operand = [index.to_column_value(v) for v in operand]
+                elif operand is not None:
+                    operand = index.to_column_value(operand)
+            else:
+                if isinstance(operand, datetime):
+                    key_path += '.iso'
+
+                key_path = self._join_extract(key_path)
 
             if value_transformer:
                 key_path = '%s(%s)' % (value_transformer, key_path)
@@ -257,7 +560,7 @@ class Query:
 
                 if type(operand) in [tuple, list]:
                     values.extend(operand)
-                elif isinstance(operand, Persistent):
+                elif isinstance(operand, (Persistent, Reference)):
                     values.append(operand.id)
                 elif isinstance(operand, datetime):
                     values.append(operand.isoformat())
@@ -266,15 +569,28 @@ class Query:
             else:
                 clauses.append('%s %s' % (key_path, operator))
 
+        for sql, filter_values in self._filters:
+            clauses.append(sql)
+            values.extend(filter_values)
+
         return ' AND '.join(clauses), values
 
 
+    def _sort_columns(self):
+        columns = [(self._column_sql(key_path), order)
+                   for key_path, order in self._sort or []]
+
+        if self._search:
+            columns.append(('"%s".rank' % self._search[0], 'ASC'))
+
+        return columns
+
+
     def _make_sort_sql(self):
-        if not self._sort:
-            return ''
+        parts = ['%s %s' % column for column in self._sort_columns()]
 
-        parts = ['%s %s' % (_extract(key_path), order)
-                 for key_path, order in self._sort]
+        if not parts:
+            return ''
 
         return 'ORDER BY %s' % ', '.join(parts)
 
@@ -289,26 +605,110 @@ class Query:
         return ''
 
 
-    def _make_sql(self, count_only=False):
+    def _make_sql(self, count_only=False, columns=None, merge=False,
+                  rowids=False):
+        """
+        With ``merge``, the SQL is for one of several shards whose
+        results are merged: the sort columns are selected after the
+        others and skipped rows are not omitted.  With ``rowids``, the
+        SQL takes two more values bounding the rowids of the objects.
+        """
+
+        if not count_only:
+            if not columns:
+                columns = [object_sql()] + [_extract(attr)
+                                      for attr in self._prefetch]
+            if merge:
+                columns = columns + [column for column, order
+                                     in self._sort_columns()]
+
         if count_only:
             parts = [ 'SELECT count(*) FROM objects' ]
         else:
-            parts = [ 'SELECT json FROM objects' ]
+            parts = [ 'SELECT %s FROM objects' % ', '.join(columns) ]
+
+        # Compile the conditions and sort order first as they may
+        # follow references which need joining.
+
+        where_sql, where_values = self._make_where_sql()
+        sort_sql = self._make_sort_sql()
+
+        if self._joins:
+            if len(database.connections) > 1:
+                raise ValueError('cannot follow references when sharding')
+            parts.extend(self._joins.values())
+
+        clauses = []
+        values = []
+
+        if self._search:
+            table, text = self._search
+            parts.append('JOIN "%s" ON "%s".rowid = objects.rowid' % (
+                table, table))
+            clauses.append('"%s" MATCH ?' % table)
+            values.append(text)
 
-        where_sql, values = self._make_where_sql()
         if len(where_sql) > 0:
-            parts.append('WHERE %s' % where_sql)
+            clauses.append('(%s)' % where_sql)
+            values.extend(where_values)
+
+        if rowids:
+            clauses.append('objects.rowid BETWEEN ? AND ?')
+
+        if clauses:
+            parts.append('WHERE %s' % ' AND '.join(clauses))
 
-        parts.append(self._make_sort_sql())
-        parts.append(self._make_limit_sql())
-        parts.append(self._make_offset_sql())
+        parts.append(sort_sql)
+
+        # Counts are of all the matching objects, whatever the skip
+        # and limit, as when summed over shards.
+
+        if count_only:
+            pass
+        elif not merge:
+            parts.append(self._make_limit_sql())
+            parts.append(self._make_offset_sql())
+        elif self._limit > 0:
+            parts.append('LIMIT %s' % (self._skip + self._limit))
 
         return ' '.join(parts), values
 
 
-    def _results(self, count_only=False):
-        sql, values = self._make_sql(count_only)
-        return database.connection.execute(sql, values or [])
+    def _results(self, count_only=False, columns=None):
+        shard = database.shard_for_class(self._cls)
+        if shard is not None:
+            sql, values = self._make_sql(count_only, columns)
+            return shard.execute(sql, values or [])
+
+        return self._merged_results(count_only, columns)
+
+
+    def _merged_results(self, count_only, columns):
+        # Run the query on every shard and merge the results
+        # as if they were from a single database.
+
+        sql, values = self._make_sql(count_only, columns, merge=True)
+        results = database.map_shards(
+            lambda shard: shard.execute(sql, values or []).fetchall())
+
+        if count_only:
+            return [(sum(rows[0][0] for rows in results),)]
+
+        sort = self._sort_columns()
+        if sort:
+            n = len(sort)
+            orders = [order for column, order in sort]
+            rows = heapq.merge(*results,
+                               key=lambda row: _SortKey(row[-n:], orders))
+        else:
+            rows = itertools.chain(*results)
+
+        stop = self._skip + self._limit if self._limit > 0 else None
+        rows = itertools.islice(rows, self._skip, stop)
+
+        if sort:
+            return [row[:-n] for row in rows]
+        return list(rows)
 
 
     def find(self):
@@ -317,22 +717,158 @@ class Query:
         or return None if there were no matches.
         """
 
-        rows = self._results().fetchall()
+        key = None
+        if database.results is not None:
+            if database.check_coherence:
+                database.invalidate_changed()
+
+            # Regexes are matched in Python so are not in the SQL.
+
+            sql, values = self._make_sql()
+            key = (sql, tuple(values), tuple(
+                (key_path, pattern.pattern, pattern.flags)
+                for key_path, pattern in self._regexes or ()))
+            ids = database.results.get(key)
+            if ids is not None:
+                objs = self._cached_objects(ids)
+                if objs and self._include:
+                    self._load_included(objs)
+                return objs
+
+        rows = list(self._results())
         if not rows:
+            if key is not None:
+                database.results.set(key, self._class_name(), [])
             return None
 
-        objs = [database.unpickle(row[0]) for row in rows]
+        if self._prefetch:
+            loaded = database.get_many(ref_id for row in rows
+                                       for ref_id in row[1:]
+                                       if type(ref_id) is str)
+
+        # References to include are loaded afterward in batches.
+
+        lazy = True if self._include else None
+        objs = [database.unpickle(row[0], lazy=lazy) for row in rows]
+
+        if self._prefetch:
+            for obj in objs:
+                for attr in self._prefetch:
+                    ref = getattr(obj, attr, None)
+                    if isinstance(ref, Reference) and not ref.is_loaded:
+                        target = loaded.get(ref.id)
+                        if target is not None:
+                            ref._bind(target)
+
+        if key is not None:
+            weights = dict((obj.id, database._weight(row[0]))
+                           for obj, row in zip(objs, rows))
+
+        if self._include:
+            self._load_included(objs)
 
         if self._regexes:
-            return self._filter_by_regexes(objs)
+            objs = self._filter_by_regexes(objs)
+
+        if key is not None:
+            for obj in objs:
+                obj.mark_clean()
+                database.objects.set(obj.id, obj, weights[obj.id])
+            database.results.set(key, self._class_name(),
+                                 [obj.id for obj in objs])
 
         return objs
 
 
+    def _class_name(self):
+        # Results of queries joining referenced objects, which may be of
+        # any class, are kept as those of queries without a class so any
+        # save or delete invalidates them.
+
+        if self._cls is None or self._joins:
+            return None
+        return qualified_class_name(self._cls)
+
+
+    def _cached_objects(self, ids):
+        # Resolve cached result ids through the object cache, loading
+        # those no longer cached in one query.
+
+        if not ids:
+            return None
+
+        database.get_many([object_id for object_id in ids
+                           if object_id not in database.objects])
+        return [database.objects[object_id] for object_id in ids]
+
+
+    def find_columns(self, *key_paths):
+        """
+        Find all matching objects and return the values at
+        ``key_paths`` as a ``Columns`` result without loading
+        any objects.  Key paths with a typed ``Index`` yield the
+        indexed column's values (datetimes as epoch seconds).
+        """
+
+        if not key_paths:
+            raise ValueError('no key paths given')
+
+        if self._regexes:
+            raise ValueError('regex filters require loading objects')
+
+        columns = [self._column_sql(key_path) for key_path in key_paths]
+        return Columns(key_paths, self._results(columns=columns))
+
+
+    def to_numpy(self, fields, chunk_size=10000):
+        """
+        Find all matching objects and return the values at the key
+        paths of ``fields``, a dict of key paths to NumPy dtypes such
+        as ``{'price': 'f8', 'qty': 'i4'}``, as a dict of NumPy arrays
+        by key path.  Rows are read ``chunk_size`` at a time straight
+        into the arrays without loading any objects.  Missing values
+        are NaN in floating point arrays, else zero or empty.
+        """
+
+        if self._regexes:
+            raise ValueError('regex filters require loading objects')
+
+        size = max(0, self.count() - self._skip)
+        if self._limit > 0:
+            size = min(size, self._limit)
+
+        columns = [self._column_sql(key_path) for key_path in fields]
+        return to_arrays(fields, self._results(columns=columns), size,
+                         chunk_size)
+
+
+    def to_dataframe(self, fields, chunk_size=10000):
+        """
+        As ``to_numpy`` but as a pandas ``DataFrame`` with a column
+        per key path.
+        """
+
+        import pandas
+        return pandas.DataFrame(self.to_numpy(fields, chunk_size))
+
+
+    def explain(self):
+        """
+        SQLite's plan for finding the matching objects, as the
+        details reported by ``EXPLAIN QUERY PLAN``.
+        """
+
+        sql, values = self._make_sql()
+        shard = database.shard_for_class(self._cls) or database.connection
+        return [row[-1] for row in
+                shard.execute('EXPLAIN QUERY PLAN ' + sql, values)]
+
+
     def _filter_by_regexes(self, objs):
         # No regex support in SQLite3 so do it in Python;
         # Only keep objects in result set that match all regexes.
 
+        import keypath
         passed = []
 
         for obj in objs:
@@ -365,11 +901,75 @@ class Query:
     def count(self):
         """
         Returns the number of objects that match
-        the query.
+        the query, ignoring any skip and limit.
         """
 
-        row = self._results(count_only=True).fetchone()
-        return int(row[0])
+        if self._is_unfiltered():
+            return sum(self._map_shards(
+                lambda shard: counts.class_count(self._cls, shard)))
+
+        rows = list(self._results(count_only=True))
+        return int(rows[0][0])
+
+
+    def estimate_count(self, sample_size=1000):
+        """
+        Returns an estimate of the number of objects that match the
+        query, from the number that match among a sample of about
+        ``sample_size`` consecutively stored objects.  Counts exactly
+        when there are too few objects to sample.
+        """
+
+        if self._is_unfiltered():
+            return self.count()
+
+        sql, values = self._make_sql(count_only=True, rowids=True)
+        class_sql = ("SELECT count(*) FROM objects WHERE "
+                     "json_extract(json, '$.py/object')=? "
+                     "AND objects.rowid BETWEEN ? AND ?")
+
+        def estimate(shard):
+            total = counts.class_count(self._cls, shard)
+            everything = counts.class_count(None, shard)
+
+            if total <= sample_size:
+                exact_sql, exact_values = self._make_sql(count_only=True)
+                return shard.execute(exact_sql, exact_values).fetchone()[0]
+
+            low, high = shard.execute(
+                "SELECT min(rowid), max(rowid) FROM objects").fetchone()
+            span = max(1, sample_size * (high - low + 1) // everything)
+            start = random.randint(low, max(low, high - span + 1))
+            window = [start, start + span - 1]
+
+            if self._cls is None:
+                sampled = shard.execute(
+                    "SELECT count(*) FROM objects WHERE rowid BETWEEN ? AND ?",
+                    window).fetchone()[0]
+            else:
+                sampled = shard.execute(
+                    class_sql,
+                    [qualified_class_name(self._cls)] + window).fetchone()[0]
+
+            if not sampled:
+                return 0
+
+            matched = shard.execute(sql, values + window).fetchone()[0]
+            return total * matched / sampled
+
+        return int(round(sum(self._map_shards(estimate))))
+
+
+    def _is_unfiltered(self):
+        # Only the class condition of the constructor?
+
+        return (self._cls is not None and not self._where and
+                not self._filters and not self._search)
+
+
+    def _map_shards(self, fn):
+        shard = database.shard_for_class(self._cls)
+        return database.map_shards(fn, None if shard is None else [shard])
 
 
 class OrQuery(Query):
@@ -389,6 +989,7 @@ class OrQuery(Query):
 
         for q in self.queries:
             where_sql, values = q._make_where_sql()
+            self._joins.update(q._joins)
             if len(where_sql) > 0:
                 all_where.append('(%s)' % where_sql)
                 all_values.extend(values)
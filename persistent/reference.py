@@ -0,0 +1,55 @@
+from . import database
+
+
+class Reference:
+    """
+    A stand-in for a referenced persistent object used when connected
+    with ``lazy_references=True``.  Only the ``id`` of the referenced
+    object is known until some other attribute is accessed, at which
+    point the object is loaded through the object cache.
+    """
+
+    __slots__ = ('id', '_target')
+
+    def __init__(self, object_id, target=None):
+        object.__setattr__(self, 'id', object_id)
+        object.__setattr__(self, '_target', target)
+
+
+    @property
+    def is_loaded(self):
+        return self._target is not None
+
+
+    def _bind(self, target):
+        object.__setattr__(self, '_target', target)
+
+
+    def resolve(self):
+        """
+        Load (if needed) and return the referenced object.
+        """
+
+        if self._target is None:
+            self._bind(database.cached(self.id))
+        return self._target
+
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
+
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+    def __repr__(self):
+        return '<Reference %s>' % self.id
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    The ids of the objects found by queries, by the query's SQL and
+    bound values, for up to ``maxsize`` queries.  Each result is kept
+    with the qualified name of the query's class (or ``None`` if the
+    query has no class) and is invalidated when an object of that
+    class (or any class, for ``None``) is saved or deleted.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._results = OrderedDict()
+        self._by_class = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self._results)
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._results.move_to_end(key)
+            return entry[1]
+
+
+    def set(self, key, class_name, ids):
+        with self._lock:
+            self._remove(key)
+            self._results[key] = (class_name, ids)
+            self._by_class.setdefault(class_name, set()).add(key)
+
+            while len(self._results) > self.maxsize:
+                self._remove(next(iter(self._results)))
+
+
+    def invalidate(self, class_name):
+        """
+        Forget the results of queries of the class with the given
+        qualified name and of queries without a class.
+        """
+
+        with self._lock:
+            for name in (class_name, None):
+                for key in list(self._by_class.get(name, ())):
+                    self._remove(key)
+
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._by_class.clear()
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    size=len(self._results),
+                    hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+    def _remove(self, key):
+        entry = self._results.pop(key, None)
+        if entry is not None:
+            self._by_class[entry[0]].discard(key)
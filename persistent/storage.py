@@ -0,0 +1,96 @@
+import sqlite3
+import zlib
+
+from .index import declared_indexes, declared_full_text, \
+    declared_unique_together
+
+
+# Whether objects are stored in SQLite's binary JSONB format,
+# supported by SQLite 3.45.0 and later, rather than as JSON text.
+
+use_jsonb = False
+
+JSONB_SUPPORTED = sqlite3.sqlite_version_info >= (3, 45, 0)
+
+# Always kept in the uncompressed JSON of compressed objects.
+
+_KEPT = ('py/object', 'id', '_version', 'created_at', 'updated_at')
+
+
+def object_sql():
+    """
+    SQL for the JSON text of a stored object.
+    """
+
+    # Only compressed objects call back into Python to inflate.  JSONB
+    # is told apart by its type, whatever the storage connected with,
+    # as the database may have been written or migrated by another.
+
+    return ("CASE WHEN objects.payload IS NOT NULL "
+            "THEN inflate(objects.payload) "
+            "WHEN typeof(objects.json) = 'blob' THEN json(objects.json) "
+            "ELSE objects.json END")
+
+
+def bind_sql():
+    """
+    SQL for the stored form of JSON text bound to a statement.
+    """
+
+    return 'jsonb(?)' if use_jsonb else 'json(?)'
+
+
+def inflate(payload):
+    """
+    SQL function which decompresses the payload of a compressed object.
+    """
+
+    if payload is None:
+        return None
+    return zlib.decompress(payload).decode('utf-8')
+
+
+def kept_attributes(cls):
+    """
+    The attributes of compressed objects of ``cls`` which are stored
+    uncompressed too so that they may be queried and indexed.
+    """
+
+    key_paths = []
+    for index in declared_indexes(cls):
+        key_paths.append(index.key_path)
+        if isinstance(index.where, dict):
+            key_paths.extend(index.where)
+    key_paths.extend(declared_full_text(cls))
+    key_paths.extend(cls.references or [])
+    key_paths.extend(cls.queryable or [])
+    for unique_key_paths in declared_unique_together(cls):
+        key_paths.extend(unique_key_paths)
+
+    kept = set(_KEPT)
+    kept.update(key_path.split('.')[0] for key_path in key_paths)
+    return kept
+
+
+def encode(obj):
+    """
+    Encode an object for storage as its JSON text and compressed
+    payload.  The payload is ``None`` unless the object's class
+    declares ``compress``, in which case the JSON holds only the
+    kept attributes.
+    """
+
+    import jsonpickle
+    text = jsonpickle.encode(obj)
+
+    if not obj.compress:
+        return text, None
+
+    import ujson
+    kept = kept_attributes(obj.__class__)
+    state = ujson.loads(text)
+    skeleton = dict((key, value) for key, value in state.items()
+                    if key in kept)
+
+    return (ujson.dumps(skeleton, escape_forward_slashes=False),
+            zlib.compress(text.encode('utf-8')))
@@ -0,0 +1,107 @@
+from collections import Counter
+
+from . import database
+from . import changes
+from . import counts
+from .index import typed_index, declared_indexes, declared_full_text, \
+    full_text_table, ensure_indexes
+from .query import Query, _extract
+
+
+def _time_index(cls):
+    key_path = cls.time_series
+    if not key_path:
+        raise ValueError('%s does not declare time_series' % cls.__name__)
+
+    ensure_indexes(cls)
+    return typed_index(cls, key_path)
+
+
+def _month_start(value):
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def partitions(cls):
+    """
+    The number of objects of the time series ``cls`` by the month
+    (as ``'YYYY-MM'``) of their time key, oldest first.
+    """
+
+    index = _time_index(cls)
+    q = Query(cls)
+    q.exists(cls.time_series)
+
+    sql, values = q._make_sql(columns=[
+        "strftime('%%Y-%%m', objects.\"%s\", 'unixepoch') AS month" %
+        index.column])
+    sql = 'SELECT month, count(*) FROM (%s) GROUP BY month' % sql
+
+    months = Counter()
+    for rows in database.map_shards(
+            lambda shard: shard.execute(sql, values).fetchall()):
+        months.update(dict(rows))
+
+    return sorted(months.items())
+
+
+def drop_partitions(cls, before, batch_size=10000):
+    """
+    Delete the objects of the time series ``cls`` whose time key is
+    in a month before that of ``before``, ``batch_size`` objects per
+    transaction, and return how many were deleted.
+
+    Objects are deleted in bulk: ``on_delete`` actions of objects
+    referencing them are not taken.
+    """
+
+    _time_index(cls)
+    cutoff = _month_start(before)
+
+    q = Query(cls)
+    q.less_than(cls.time_series, cutoff)
+    q.limit(batch_size)
+    sql, values = q._make_sql(columns=[
+        'objects.rowid',
+        _extract('id'),
+        'coalesce(%s, 0)' % _extract('_version')])
+
+    elements = any(index.multi_value for index in declared_indexes(cls))
+    full_text = declared_full_text(cls)
+    references = cls.references
+
+    def drop(shard):
+        n = 0
+        while True:
+            with shard:
+                rows = shard.execute(sql, values).fetchall()
+                if not rows:
+                    return n
+
+                rowids = [row[0] for row in rows]
+                ids = [row[1] for row in rows]
+                binds = ','.join(['?'] * len(rows))
+
+                if elements:
+                    shard.execute("DELETE FROM object_elements "
+                                  "WHERE object IN (%s)" % binds, rowids)
+                if full_text:
+                    shard.execute('DELETE FROM "%s" WHERE rowid IN (%s)' % (
+                        full_text_table(cls), binds), rowids)
+                if references:
+                    shard.execute("DELETE FROM object_references "
+                                  "WHERE source IN (%s)" % binds, ids)
+
+                shard.execute("DELETE FROM objects WHERE rowid IN (%s)" %
+                              binds, rowids)
+                counts.record(shard, cls, -len(rows))
+                changes.record_deletes(shard, cls, [
+                    (row[1], row[2] + 1) for row in rows])
+
+            for object_id in ids:
+                database.objects.pop(object_id, None)
+
+            n += len(rows)
+
+    n = sum(database.map_shards(drop))
+    database.invalidate_results(cls)
+    return n
@@ -0,0 +1,171 @@
+import importlib
+import logging
+import sqlite3
+
+from . import database
+from . import storage
+from . import counts
+from . import changes
+from .index import rebuild_indexes, _definition
+
+
+logger = logging.getLogger(__name__)
+
+
+def export_jsonl(out, class_names=None, progress=None, batch_size=1000):
+    """
+    Write each stored object (of the given qualified class names,
+    if any) to the file ``out`` as a line of JSON, as stored and
+    without loading the object.  Returns the number of objects.
+    ``progress`` is called with the running count after each batch.
+    """
+
+    sql = 'SELECT %s FROM objects' % storage.object_sql()
+    values = []
+
+    if class_names:
+        sql += " WHERE json_extract(json, '$.py/object') IN (%s)" % (
+            ','.join(['?'] * len(class_names)))
+        values.extend(class_names)
+
+    sql += ' ORDER BY rowid'
+
+    n = 0
+    for shard in database.connections:
+        cursor = shard.execute(sql, values)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for row in rows:
+                out.write(row[0])
+                out.write('\n')
+
+            n += len(rows)
+            if progress:
+                progress(n)
+
+    return n
+
+
+def _secondary_indexes(connection):
+    # Unique indexes are kept to reject duplicates as they are inserted.
+
+    return [(name, sql) for name, sql in connection.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='index' "
+        "AND tbl_name='objects' AND sql IS NOT NULL "
+        "AND name != 'id_index'").fetchall()
+        if not _definition(sql)[0]]
+
+
+def _import_class(class_name):
+    module_name, _, name = class_name.rpartition('.')
+    try:
+        return getattr(importlib.import_module(module_name), name)
+    except (ImportError, AttributeError, ValueError):
+        return None
+
+
+def import_jsonl(lines, progress=None, batch_size=1000):
+    """
+    Insert the objects in ``lines`` of JSON, as written by
+    ``export_jsonl``, in batches of ``batch_size`` objects per
+    transaction.  Secondary indexes other than unique indexes are
+    dropped during the import and rebuilt afterward, as are the
+    full-text and multi-value indexes of classes which can be
+    imported, and the class counts.  Each object's insertion is
+    recorded in the change log.  Returns the number of objects.
+
+    An object violating a unique index raises ``IntegrityError``; the
+    batches before its batch stay imported and the indexes and class
+    counts are still rebuilt.
+
+    Objects are stored uncompressed.  Only use on an unsharded database.
+    """
+
+    if len(database.connections) > 1:
+        raise ValueError('cannot import into a sharded database')
+
+    connection = database.connection
+    indexes = _secondary_indexes(connection)
+
+    with connection:
+        for name, sql in indexes:
+            connection.execute('DROP INDEX "%s"' % name)
+
+    sql = 'INSERT INTO objects (json) VALUES (%s)' % storage.bind_sql()
+    class_names = set()
+    n = 0
+
+    try:
+        batch = []
+        for line in lines:
+            line = line.strip()
+            if line:
+                batch.append((line,))
+
+            if len(batch) >= batch_size:
+                n += _insert(connection, sql, batch, class_names)
+                batch = []
+                if progress:
+                    progress(n)
+
+        if batch:
+            n += _insert(connection, sql, batch, class_names)
+            if progress:
+                progress(n)
+    finally:
+        with connection:
+            for name, index_sql in indexes:
+                connection.execute(index_sql)
+
+            for class_name in sorted(class_names):
+                cls = _import_class(class_name)
+                if cls is None:
+                    logger.warning('cannot import %s to rebuild its indexes',
+                                   class_name)
+                else:
+                    rebuild_indexes(cls)
+
+            counts.rebuild(connection)
+
+        connection.execute('ANALYZE')
+
+    return n
+
+
+def _insert(connection, sql, batch, class_names):
+    with connection:
+        connection.executemany(sql, batch)
+
+        last = connection.execute('SELECT last_insert_rowid()').fetchone()[0]
+        class_names.update(row[0] for row in connection.execute(
+            "SELECT DISTINCT json_extract(json, '$.py/object') FROM objects "
+            "WHERE rowid > ? - ?", (last, len(batch))))
+        changes.record_inserts(connection, last - len(batch))
+
+    return len(batch)
+
+
+def backup(path, pages=1024, progress=None):
+    """
+    Copy the database (each shard to ``path`` suffixed with ``.0``,
+    ``.1``, etc. when sharding) to ``path`` while it remains in use.
+    ``pages`` are copied at a time; ``progress`` is called with the
+    numbers of pages remaining and in total after each step.
+    """
+
+    def report(status, remaining, total):
+        if progress:
+            progress(remaining, total)
+
+    paths = [path] if len(database.connections) == 1 else [
+        '%s.%d' % (path, i) for i in range(len(database.connections))]
+
+    for shard, shard_path in zip(database.connections, paths):
+        target = sqlite3.connect(shard_path)
+        try:
+            shard.backup(target, pages=pages, progress=report)
+        finally:
+            target.close()
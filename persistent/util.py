@@ -0,0 +1,7 @@
+def qualified_class_name(cls):
+    """
+    The name of ``cls`` qualified by its module, as stored in the
+    ``py/object`` of the class's objects.
+    """
+
+    return '%s.%s' % (cls.__module__, cls.__name__)
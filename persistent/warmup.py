@@ -0,0 +1,88 @@
+import logging
+import sqlite3
+import threading
+
+from . import database
+from . import storage
+from .query import Query
+
+
+logger = logging.getLogger(__name__)
+
+
+def warm(query_or_classes, limit=None, chunk_size=500, background=False):
+    """
+    Load the objects matching a ``Query``, or of a class or list of
+    classes, into the object cache ``chunk_size`` rows at a time and
+    up to ``limit`` objects in all.  Returns the number of objects
+    loaded.
+
+    With ``background``, the objects are loaded in a daemon thread over
+    connections of its own, which is returned.  Objects loaded in the
+    background hold lazy references (see ``lazy_references``) since
+    the thread cannot load referenced objects over the main connection.
+    A database in memory cannot be warmed in the background.
+    """
+
+    if isinstance(query_or_classes, Query):
+        queries = [query_or_classes]
+    elif isinstance(query_or_classes, type):
+        queries = [Query(query_or_classes)]
+    else:
+        queries = [Query(cls) for cls in query_or_classes]
+
+    if not background:
+        return _warm(queries, limit, chunk_size, database.connections, False)
+
+    paths = [shard.execute('PRAGMA database_list').fetchone()[2]
+             for shard in database.connections]
+    if not all(paths):
+        raise ValueError('cannot warm a database in memory in the background')
+
+    def run():
+        shards = [sqlite3.connect(path) for path in paths]
+        try:
+            for shard in shards:
+                shard.create_function('inflate', 1, storage.inflate,
+                                      deterministic=True)
+            n = _warm(queries, limit, chunk_size, shards, True)
+            logger.info('warmed the object cache with %d objects', n)
+        except Exception:
+            logger.exception('failed to warm the object cache')
+        finally:
+            for shard in shards:
+                shard.close()
+
+    thread = threading.Thread(target=run, name='persistent-warm',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def _warm(queries, limit, chunk_size, shards, lazy):
+    n = 0
+
+    for query in queries:
+        sql, values = query._make_sql(columns=[storage.object_sql()])
+
+        for shard in shards:
+            cursor = shard.execute(sql, values)
+
+            while limit is None or n < limit:
+                size = chunk_size if limit is None else min(chunk_size,
+                                                            limit - n)
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+
+                for row in rows:
+                    obj = database.unpickle(row[0], lazy=lazy)
+                    obj.mark_clean()
+                    database.objects.set(obj.id, obj,
+                                         database._weight(row[0]))
+
+                n += len(rows)
+
+            cursor.close()
+
+    return n
@@ -1,5 +1,8 @@
 import os
 import sqlite3
+import subprocess
+import sys
+import time
 from datetime import datetime, timedelta
 
 import pytest
@@ -19,6 +22,50 @@ class C(persistent.Persistent):
     references = [ 'ref0', 'ref1' ]
 
 
+class D(persistent.Persistent):
+    indexes = [ persistent.Index('price', type=float),
+                persistent.Index('when', type=datetime) ]
+
+
+class E(persistent.Persistent):
+    full_text = [ 'title', 'body' ]
+
+
+class F(persistent.Persistent):
+    indexes = [ persistent.Index('tags', multi_value=True) ]
+
+
+class G(persistent.Persistent):
+    compress = True
+    queryable = [ 'name' ]
+    indexes = [ persistent.Index('n', type=int) ]
+
+
+class H(persistent.Persistent):
+    references = [ 'owner' ]
+    on_delete = { 'owner': 'cascade' }
+
+
+class I(persistent.Persistent):
+    references = [ 'owner' ]
+    on_delete = { 'owner': 'restrict' }
+
+
+class J(persistent.Persistent):
+    indexes = [ persistent.Index('n', type=int) ]
+    unique_together = [ ('a', 'b.c') ]
+
+
+class L(persistent.Persistent):
+    time_series = 'at'
+    full_text = [ 'message' ]
+
+
+class K(persistent.Persistent):
+    indexes = [ persistent.Index('due', type=datetime,
+                                 where={ 'status': 'active' }) ]
+
+
 def test_connect():
     persistent.connect()
 
@@ -906,3 +953,1048 @@ def test_query_dates():
     a1.save()
     assert persistent.Query(A).less_than('a_date', datetime.utcnow()).count() == 2
 
+
+
+def test_typed_index_range():
+    persistent.connect(debug=True)
+    for price in [10, 2.5, 30]:
+        d = D()
+        d.price = price
+        d.save()
+    q = persistent.Query(D)
+    q.greater_than('price', 5)
+    q.ascending('price')
+    objs = q.find()
+    assert [obj.price for obj in objs] == [10, 30]
+
+
+def test_typed_index_datetime():
+    persistent.connect(debug=True)
+    now = datetime.utcnow()
+    d0 = D()
+    d0.when = now - timedelta(days=2)
+    d0.save()
+    d1 = D()
+    d1.when = now
+    d1.save()
+    q = persistent.Query(D)
+    q.greater_than('when', now - timedelta(days=1))
+    objs = q.find()
+    assert len(objs) == 1
+    assert objs[0].id == d1.id
+
+
+def test_typed_index_used_by_query_plan():
+    import persistent.database
+    persistent.connect(debug=True)
+    d = D()
+    d.price = 1.0
+    d.save()
+    q = persistent.Query(D)
+    q.less_than('price', 2)
+    sql, values = q._make_sql()
+    plan = persistent.database.connection.execute(
+        'EXPLAIN QUERY PLAN ' + sql, values).fetchall()
+    assert any('price__float' in row[-1] for row in plan)
+
+
+def test_search():
+    persistent.connect(debug=True)
+    e0 = E()
+    e0.title = 'Persistent objects'
+    e0.body = 'Stored in SQLite'
+    e0.save()
+    e1 = E()
+    e1.title = 'Other things'
+    e1.body = 'Nothing about objects in here; objects objects'
+    e1.save()
+    e2 = E()
+    e2.title = 'Unrelated'
+    e2.body = 'Unrelated'
+    e2.save()
+    objs = persistent.Query(E).search('objects').find()
+    assert len(objs) == 2
+    assert objs[0].id == e1.id
+    objs = persistent.Query(E).search('objects', fields=['title']).find()
+    assert len(objs) == 1
+    assert objs[0].id == e0.id
+    assert persistent.Query(E).search('sqlite').count() == 1
+
+
+def test_search_after_update_and_delete():
+    persistent.connect(debug=True)
+    e = E()
+    e.title = 'before'
+    e.save()
+    e.title = 'after'
+    e.save()
+    assert persistent.Query(E).search('before').find() is None
+    assert persistent.Query(E).search('after').first().id == e.id
+    e.delete()
+    assert persistent.Query(E).search('after').find() is None
+
+
+def test_search_undeclared():
+    persistent.connect(debug=True)
+    with pytest.raises(ValueError):
+        persistent.Query(A).search('x')
+    with pytest.raises(ValueError):
+        persistent.Query(E).search('x', fields=['nope'])
+
+
+def test_has_element():
+    persistent.connect(debug=True)
+    f0 = F()
+    f0.tags = ['red', 'green']
+    f0.save()
+    f1 = F()
+    f1.tags = ['blue', 'blue']
+    f1.save()
+    objs = persistent.Query(F).has_element('tags', 'green').find()
+    assert len(objs) == 1
+    assert objs[0].id == f0.id
+    assert persistent.Query(F).has_any('tags', ['red', 'blue']).count() == 2
+    f0.tags = ['yellow']
+    f0.save()
+    assert persistent.Query(F).has_element('tags', 'green').find() is None
+    f1.delete()
+    assert persistent.Query(F).has_element('tags', 'blue').find() is None
+
+
+def test_has_element_without_index():
+    persistent.connect(debug=True)
+    a0 = A()
+    a0.foo = [1, 2]
+    a0.save()
+    a1 = A()
+    a1.foo = [3]
+    a1.save()
+    objs = persistent.Query(A).has_element('foo', 2).find()
+    assert len(objs) == 1
+    assert objs[0].id == a0.id
+
+
+def test_lazy_references():
+    persistent.connect(debug=True, lazy_references=True)
+    c = A()
+    c.foo = 1
+    b = B()
+    b.ref0 = c
+    b.save()
+    bp = persistent.get(b.id)
+    assert isinstance(bp.ref0, persistent.Reference)
+    assert not bp.ref0.is_loaded
+    assert bp.ref0.id == c.id
+    assert bp.ref0.foo == 1
+    assert bp.ref0.is_loaded
+    assert bp.ref0 == c
+    bp.bar = 2
+    bp.save()
+    assert persistent.get(b.id).ref0.id == c.id
+    assert persistent.Query(B).equal_to('ref0', bp.ref0).count() == 1
+
+
+def test_query_prefetch():
+    persistent.connect(debug=True, lazy_references=True, cache_size=0)
+    for i in range(3):
+        a = A()
+        a.foo = i
+        b = B()
+        b.ref0 = a
+        b.save()
+    objs = persistent.Query(B).prefetch('ref0').find()
+    assert len(objs) == 3
+    assert all(obj.ref0.is_loaded for obj in objs)
+    assert sorted(obj.ref0.foo for obj in objs) == [0, 1, 2]
+
+
+def test_find_columns():
+    persistent.connect(debug=True)
+    for i, price in enumerate([1.5, 2, 3.25]):
+        d = D()
+        d.price = price
+        d.qty = i
+        d.name = 'd%s' % i
+        d.save()
+    q = persistent.Query(D)
+    q.ascending('qty')
+    cols = q.find_columns('price', 'qty', 'name', 'missing')
+    assert len(cols) == 3
+    assert list(cols['price']) == [1.5, 2.0, 3.25]
+    assert list(cols['qty']) == [0, 1, 2]
+    assert cols['name'] == ['d0', 'd1', 'd2']
+    assert cols['missing'] == [None, None, None]
+    assert list(cols.rows())[0] == (1.5, 0, 'd0', None)
+
+
+def test_find_columns_packed():
+    from array import array
+    persistent.connect(debug=True)
+    a = A()
+    a.foo = 1
+    a.save()
+    cols = persistent.Query(A).find_columns('foo')
+    assert isinstance(cols['foo'], array) or hasattr(cols['foo'], 'dtype')
+
+
+def test_sharded_save_get_query():
+    import persistent.database
+    persistent.connect(debug=True, shards=3)
+    objs = []
+    for i in range(20):
+        a = A()
+        a.foo = i
+        a.save()
+        objs.append(a)
+    counts = [shard.execute('SELECT count(*) FROM objects').fetchone()[0]
+              for shard in persistent.database.connections]
+    assert sum(counts) == 20
+    assert all(n > 0 for n in counts)
+    for a in objs:
+        assert persistent.get(a.id).foo == a.foo
+    assert persistent.Query(A).count() == 20
+    q = persistent.Query(A)
+    q.greater_than('foo', 3)
+    q.descending('foo')
+    q.skip(2)
+    q.limit(5)
+    assert [obj.foo for obj in q.find()] == [17, 16, 15, 14, 13]
+
+
+def test_sharded_by_class():
+    import persistent.database
+    persistent.connect(debug=True, shards=2, shard_by='class')
+    a = A()
+    a.foo = 1
+    b = B()
+    b.ref0 = a
+    b.save()
+    assert persistent.get(b.id).ref0.id == a.id
+    assert persistent.Query(A).count() == 1
+    assert len(persistent.OrQuery(persistent.Query(A),
+                                  persistent.Query(B)).find()) == 2
+
+
+def test_sharded_transaction():
+    persistent.connect(debug=True, shards=2)
+    a0 = A()
+    a1 = A()
+    with persistent.transaction():
+        a0.save(use_transaction=False)
+        a1.save(use_transaction=False)
+    assert persistent.Query(A).count() == 2
+
+
+def test_changes_since():
+    persistent.connect(debug=True)
+    a = A()
+    a.foo = 1
+    a.save()
+    a.foo = 2
+    a.save()
+    a.delete()
+    changes = list(persistent.changes_since(0))
+    assert [c.op for c in changes] == ['insert', 'update', 'delete']
+    assert [c.version for c in changes] == [1, 2, 3]
+    assert all(c.id == a.id for c in changes)
+    assert changes[0].cls == 'tests.A'
+    assert list(persistent.changes_since(changes[1].seq)) == changes[2:]
+    assert list(persistent.changes_since(0, limit=1)) == changes[:1]
+    assert len(list(persistent.changes_since(0, batch_size=2))) == 3
+    persistent.truncate_changes(changes[2].seq)
+    assert list(persistent.changes_since(0)) == changes[2:]
+
+
+def test_changes_deleting_unsaved():
+    persistent.connect(debug=True)
+    a = A()
+    a.delete()
+    a.delete()
+    assert list(persistent.changes_since(0)) == []
+
+
+def test_changes_imported():
+    import io
+    import persistent.tools
+    persistent.connect(debug=True)
+    a = A()
+    a.save()
+    a.foo = 1
+    a.save()
+    out = io.StringIO()
+    persistent.tools.export_jsonl(out)
+    persistent.connect(debug=True)
+    persistent.tools.import_jsonl(out.getvalue().splitlines())
+    changes = list(persistent.changes_since(0))
+    assert [(c.id, c.cls, c.op, c.version) for c in changes] == [
+        (a.id, 'tests.A', 'insert', 2)]
+
+
+def test_changes_rolled_back_with_transaction():
+    persistent.connect(debug=True)
+    a = A()
+    with pytest.raises(RuntimeError):
+        with persistent.transaction():
+            a.save(use_transaction=False)
+            raise RuntimeError()
+    assert list(persistent.changes_since(0)) == []
+
+
+def test_version():
+    persistent.connect(debug=True)
+    a = A()
+    assert a.persistent_version == 0
+    a.save()
+    assert a.persistent_version == 1
+    a.foo = 1
+    a.save()
+    assert a.persistent_version == 2
+    assert persistent.get(a.id).persistent_version == 2
+    assert [c.version for c in persistent.changes_since(0)] == [1, 2]
+    a.version = 7
+    a.save()
+    assert persistent.get(a.id).version == 7
+
+
+def test_coherent_cache():
+    import persistent.database
+    path = '.test_coherence.sqlite3'
+    try:
+        persistent.connect(db_path=path, coherent_cache=True)
+        a = A()
+        a.foo = 1
+        a.save()
+        assert persistent.database.cached(a.id).foo == 1
+        other = sqlite3.connect(path)
+        other.execute("UPDATE objects SET json=json_set(json, '$.foo', 2)")
+        other.execute("INSERT INTO changes (id, class, op, version, timestamp) "
+                      "VALUES (?, 'tests.A', 'update', 2, '')", (a.id,))
+        other.commit()
+        other.close()
+        assert persistent.database.cached(a.id).foo == 2
+    finally:
+        persistent.database.connection.close()
+        os.remove(path)
+
+
+def test_conflict():
+    persistent.connect(debug=True)
+    a = A()
+    a.foo = 1
+    a.save()
+    b = persistent.get(a.id)
+    b.foo = 2
+    b.save()
+    a.foo = 3
+    with pytest.raises(persistent.ConflictError):
+        a.save()
+    assert a.is_dirty
+    assert a.persistent_version == 1
+    assert persistent.get(a.id).foo == 2
+
+
+def test_conflict_deleted():
+    persistent.connect(debug=True)
+    a = A()
+    a.save()
+    persistent.get(a.id).delete()
+    a.foo = 1
+    with pytest.raises(persistent.ConflictError):
+        a.save()
+
+
+def test_compressed_storage():
+    import persistent.database
+    persistent.connect(debug=True)
+    g = G()
+    g.name = 'big'
+    g.n = 3
+    g.body = 'lorem ipsum ' * 1000
+    g.save()
+    json, payload = persistent.database.connection.execute(
+        'SELECT json, payload FROM objects').fetchone()
+    assert 'lorem' not in json
+    assert len(payload) < 1000
+    h = persistent.get(g.id)
+    assert h.body == g.body
+    assert persistent.Query(G).equal_to('name', 'big').first().body == g.body
+    assert persistent.Query(G).greater_than('n', 2).count() == 1
+    h.body = 'short'
+    h.save()
+    assert persistent.get(g.id).body == 'short'
+
+
+def test_jsonb_storage():
+    import persistent.storage
+    persistent.connect(debug=True, storage='jsonb')
+    assert persistent.storage.use_jsonb == persistent.storage.JSONB_SUPPORTED
+    a = A()
+    a.foo = 1
+    a.save()
+    assert persistent.get(a.id).foo == 1
+    assert persistent.Query(A).equal_to('foo', 1).count() == 1
+
+
+@pytest.mark.skipif(not persistent.storage.JSONB_SUPPORTED,
+                    reason='SQLite does not support JSONB')
+def test_read_jsonb_connected_as_text(tmpdir):
+    import io
+    import persistent.tools
+    path = str(tmpdir.join('db.sqlite3'))
+    persistent.connect(db_path=path, storage='jsonb')
+    a = A()
+    a.foo = 1
+    a.save()
+    persistent.connect(db_path=path)
+    persistent.migrate_storage('jsonb')
+    persistent.connect(db_path=path)
+    assert persistent.get(a.id).foo == 1
+    assert persistent.Query(A).equal_to('foo', 1).first().id == a.id
+    out = io.StringIO()
+    persistent.tools.export_jsonl(out)
+    assert a.id in out.getvalue()
+
+
+def test_migrate_storage():
+    persistent.connect(debug=True)
+    a = A()
+    a.foo = 1
+    a.save()
+    persistent.migrate_storage('text', batch_size=1)
+    assert persistent.get(a.id).foo == 1
+    with pytest.raises(ValueError):
+        persistent.migrate_storage('xml')
+    with pytest.raises(ValueError):
+        persistent.connect(storage='xml')
+
+
+def test_export_import():
+    import io
+    import persistent.tools
+    persistent.connect(debug=True)
+    a = A()
+    a.foo = 1
+    a.save()
+    f = F()
+    f.tags = ['x']
+    f.save()
+    out = io.StringIO()
+    assert persistent.tools.export_jsonl(out) == 2
+    assert persistent.tools.export_jsonl(io.StringIO(), ['tests.A']) == 1
+    persistent.connect(debug=True)
+    lines = out.getvalue().splitlines()
+    assert persistent.tools.import_jsonl(lines, batch_size=1) == 2
+    assert persistent.get(a.id).foo == 1
+    assert persistent.Query(F).has_element('tags', 'x').first().id == f.id
+    assert persistent.Query(A).count() == 1
+
+
+def test_backup():
+    import persistent.tools
+    persistent.connect(debug=True)
+    a = A()
+    a.save()
+    progress = []
+    try:
+        persistent.tools.backup('.test_backup.sqlite3', pages=1,
+                                progress=lambda *args: progress.append(args))
+        persistent.connect(db_path='.test_backup.sqlite3')
+        assert persistent.get(a.id).id == a.id
+        assert progress
+    finally:
+        persistent.database.connection.close()
+        os.remove('.test_backup.sqlite3')
+
+
+def test_cli_export(tmpdir, capsys):
+    import persistent.__main__
+    path = str(tmpdir.join('db.sqlite3'))
+    persistent.connect(db_path=path)
+    a = A()
+    a.save()
+    persistent.database.connection.close()
+    persistent.__main__.main(['export', path])
+    assert a.id in capsys.readouterr().out
+
+
+def test_cli_sharded_backup(tmpdir, capsys):
+    import persistent.__main__
+    path = str(tmpdir.join('db.sqlite3'))
+    dest = str(tmpdir.join('backup.sqlite3'))
+    persistent.connect(db_path=path, shards=2)
+    ids = []
+    for i in range(4):
+        a = A()
+        a.save()
+        ids.append(a.id)
+    persistent.__main__.main(['backup', path, dest, '--shards', '2'])
+    persistent.__main__.main(['export', dest, '--shards', '2'])
+    out = capsys.readouterr().out
+    assert all(object_id in out for object_id in ids)
+
+
+def test_cache_bytes():
+    persistent.connect(debug=True, cache_bytes=1000)
+    ids = []
+    for i in range(20):
+        a = A()
+        a.foo = 'x' * 100
+        a.save()
+        ids.append(a.id)
+    for object_id in ids:
+        persistent.database.cached(object_id)
+    stats = persistent.cache_stats()
+    assert stats['misses'] == 20
+    assert 0 < stats['weight'] <= 1000
+    assert stats['size'] < 20
+
+
+def test_cache_quotas_and_ttl():
+    from persistent.cache import ObjectCache
+    cache = ObjectCache(10, load=lambda key: (A(), 1),
+                        ttl=60, quotas={A: 2})
+    cache['a']
+    cache['b']
+    cache['c']
+    assert 'a' not in cache and len(cache) == 2
+    cache = ObjectCache(10, load=lambda key: (A(), 1), ttl=-1)
+    cache['a']
+    cache['a']
+    assert cache.stats()['misses'] == 2
+
+
+def test_cache_slru_scan_resistant():
+    from persistent.cache import ObjectCache
+    cache = ObjectCache(10, load=lambda key: (A(), 1), policy='slru')
+    for key in ('hot1', 'hot2', 'hot1', 'hot2'):
+        cache[key]
+    for i in range(100):
+        cache['scan%d' % i]
+    assert 'hot1' in cache and 'hot2' in cache
+    cache = ObjectCache(10, load=lambda key: (A(), 1))
+    for key in ('hot1', 'hot2', 'hot1', 'hot2'):
+        cache[key]
+    for i in range(100):
+        cache['scan%d' % i]
+    assert 'hot1' not in cache
+
+
+def test_warm():
+    persistent.connect(debug=True)
+    for i in range(5):
+        a = A()
+        a.foo = i
+        a.save()
+    assert persistent.warm(A, limit=3, chunk_size=2) == 3
+    assert persistent.cache_stats()['size'] == 3
+    q = persistent.Query(A)
+    q.greater_than('foo', 2)
+    assert persistent.warm(q) == 2
+
+
+def test_warm_background_and_hot_ids(tmpdir):
+    path = str(tmpdir.join('db.sqlite3'))
+    hot_ids = str(tmpdir.join('hot_ids'))
+    persistent.connect(db_path=path, hot_ids_path=hot_ids)
+    a = A()
+    a.save()
+    persistent.warm([A], background=True).join()
+    assert a.id in persistent.database.objects
+    persistent.database.save_hot_ids()
+    persistent.connect(db_path=path, hot_ids_path=hot_ids)
+    assert a.id in persistent.database.objects
+
+
+def test_query_cache():
+    persistent.connect(debug=True, query_cache_size=10)
+    a = A()
+    a.foo = 1
+    a.save()
+    q = persistent.Query(A)
+    q.equal_to('foo', 1)
+    assert [o.id for o in q.find()] == [a.id]
+    assert q.find()[0] is persistent.database.objects[a.id]
+    assert persistent.query_cache_stats()['hits'] == 1
+    b = A()
+    b.foo = 1
+    b.save()
+    assert len(q.find()) == 2
+    assert persistent.query_cache_stats()['misses'] == 2
+    b.delete()
+    assert len(q.find()) == 1
+    c = B()
+    c.save()
+    q.find()
+    assert persistent.query_cache_stats()['hit_rate'] == 0.4
+
+
+def test_query_cache_regexes():
+    persistent.connect(debug=True, query_cache_size=10)
+    for name in ('apple', 'banana'):
+        a = A()
+        a.name = name
+        a.save()
+    assert [a.name for a in persistent.Query(A).matches('name', '^a')
+            .find()] == ['apple']
+    assert [a.name for a in persistent.Query(A).matches('name', '^b')
+            .find()] == ['banana']
+
+
+def test_class_counts():
+    persistent.connect(debug=True)
+    objs = [A() for i in range(3)]
+    for a in objs:
+        a.save()
+    B().save()
+    assert persistent.Query(A).count() == 3
+    objs[0].delete()
+    objs[0].delete()
+    assert persistent.Query(A).count() == 2
+    row = persistent.database.connection.execute(
+        "SELECT n FROM class_counts WHERE class='tests.A'").fetchone()
+    assert row[0] == 2
+
+
+def test_estimate_count():
+    persistent.connect(debug=True)
+    with persistent.transaction():
+        for i in range(2000):
+            a = A()
+            a.foo = i % 4
+            a.save(use_transaction=False)
+            B().save(use_transaction=False)
+    q = persistent.Query(A)
+    q.equal_to('foo', 1)
+    assert 250 <= q.estimate_count(sample_size=400) <= 750
+    assert q.estimate_count(sample_size=5000) == 500
+    assert persistent.Query(A).estimate_count() == 2000
+
+
+def test_query_follows_references():
+    persistent.connect(debug=True)
+    for name, country in [('b', 'DE'), ('a', 'US'), ('c', 'DE')]:
+        a = A()
+        a.name = name
+        a.country = country
+        b = B()
+        b.ref0 = a
+        b.save()
+    q = persistent.Query(B)
+    q.equal_to('ref0->country', 'DE')
+    q.descending('ref0->name')
+    assert [b.ref0.name for b in q.find()] == ['c', 'b']
+    assert q.count() == 2
+    c = C()
+    c.ref0 = B()
+    c.ref0.ref0 = a
+    c.save()
+    q = persistent.Query(C)
+    q.equal_to('ref0->ref0->name', 'c')
+    assert q.first().id == c.id
+    b = B()
+    b.save()
+    q = persistent.Query(B)
+    q.does_not_exist('ref0->country')
+    assert q.first().id == b.id
+
+
+
+def test_query_cache_joins():
+    persistent.connect(debug=True, query_cache_size=10)
+    a = A()
+    a.country = 'DE'
+    b = B()
+    b.ref0 = a
+    b.save()
+    q = persistent.Query(B)
+    q.equal_to('ref0->country', 'DE')
+    assert len(q.find()) == 1
+    a.country = 'FR'
+    a.save()
+    assert q.find() is None
+
+
+def test_referrers():
+    persistent.connect(debug=True)
+    a = A()
+    a.save()
+    b = B()
+    b.ref0 = a
+    b.save()
+    c = C()
+    c.ref0 = b
+    c.ref1 = a
+    c.save()
+    assert sorted(o.id for o in persistent.referrers(a)) == sorted([b.id, c.id])
+    assert [o.id for o in persistent.referrers(a.id, 'ref1')] == [c.id]
+    c.ref1 = None
+    c.save()
+    assert [o.id for o in persistent.referrers(a)] == [b.id]
+    b.delete()
+    assert persistent.referrers(a) == []
+
+
+def test_delete_cascade_and_restrict():
+    persistent.connect(debug=True)
+    a = A()
+    a.save()
+    h = H()
+    h.owner = a
+    h.save()
+    a.delete()
+    with pytest.raises(persistent.NotFoundError):
+        persistent.get(h.id)
+    a = A()
+    a.save()
+    i = I()
+    i.owner = a
+    i.save()
+    with pytest.raises(persistent.ReferencedError):
+        a.delete()
+    assert persistent.get(a.id).id == a.id
+    i.delete()
+    a.delete()
+
+
+def test_include():
+    for lazy in (False, True):
+        persistent.connect(debug=True, lazy_references=lazy)
+        shared = A()
+        shared.name = 'shared'
+        shared.save()
+        for i in range(3):
+            b = B()
+            b.ref0 = shared
+            c = C()
+            c.ref0 = b
+            c.ref1 = A()
+            c.save()
+        persistent.database.objects.clear()
+        queries = []
+        persistent.database.connection.set_trace_callback(queries.append)
+        objs = persistent.Query(C).include('ref0.ref0').find()
+        persistent.database.connection.set_trace_callback(None)
+        assert len(queries) == (3 if lazy else 6)
+        assert all(c.ref0.ref0.name == 'shared' for c in objs)
+        if not lazy:
+            assert type(objs[0].ref1) is A
+            assert objs[0].ref0.ref0 is objs[1].ref0.ref0
+        else:
+            assert not objs[0].ref1.is_loaded
+            objs = persistent.Query(C).include(depth=2).find()
+            assert objs[0].ref1.is_loaded and objs[0].ref0.ref0.is_loaded
+
+
+def test_unique_together():
+    persistent.connect(debug=True)
+    x = J()
+    x.a = 1
+    x.b = dict(c=1)
+    x.save()
+    y = J()
+    y.a = 1
+    y.b = dict(c=1)
+    with pytest.raises(persistent.UniquenessError):
+        y.save()
+    y.b = dict(c=2)
+    y.save()
+
+
+def test_reconcile_indexes(tmpdir):
+    path = str(tmpdir.join('db.sqlite3'))
+
+    def index_names():
+        return set(row[0] for row in persistent.database.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='index'"))
+
+    persistent.connect(db_path=path)
+    assert 'tests_J__n__int__idx' in index_names()
+    assert 'tests_J__a__b_c__uniq' in index_names()
+    with persistent.transaction():
+        for i in range(5):
+            j = J()
+            j.n = i
+            j.save(use_transaction=False)
+        d = D()
+        d.price = 1.0
+        d.save(use_transaction=False)
+    J.indexes = []
+    try:
+        persistent.connect(db_path=path)
+        assert persistent.database.index_builder is None
+        assert 'tests_J__n__int__idx' not in index_names()
+    finally:
+        J.indexes = [ persistent.Index('n', type=int) ]
+    persistent.connect(db_path=path, background_index_rows=2)
+    persistent.database.index_builder.join()
+    assert 'tests_J__n__int__idx' in index_names()
+    stats = dict(persistent.database.connection.execute(
+        "SELECT idx, stat FROM sqlite_stat1").fetchall())
+    assert stats['tests_J__n__int__idx'].startswith('5 ')
+    assert not stats.get('tests_D__price__float__idx', '').startswith('1 ')
+
+
+def test_partial_indexes():
+    persistent.connect(debug=True)
+    for i in range(10):
+        k = K()
+        k.status = 'active' if i % 2 else 'done'
+        k.due = datetime(2020, 1, 1) + timedelta(days=i)
+        k.save()
+    sql = persistent.database.connection.execute(
+        "SELECT sql FROM sqlite_master WHERE name='tests_K__due__epoch__idx'"
+        ).fetchone()[0]
+    assert "WHERE +json_extract(json, '$.py/object')='tests.K'" in sql
+    assert "json_extract(json, '$.status')='active'" in sql
+    q = persistent.Query(K)
+    q.equal_to('status', 'active')
+    q.greater_than('due', datetime(2020, 1, 4))
+    assert any('tests_K__due__epoch__idx' in detail
+               for detail in q.explain())
+    assert len(q.find()) == 3
+    q = persistent.Query(J)
+    q.greater_than('n', 1)
+    assert any('tests_J__n__int__idx' in detail for detail in q.explain())
+    name = persistent.add_index(['x'], cls=K, where={ 'status': 'done' })
+    assert name == 'x__idx__tests_K'
+
+
+def test_planner_prefers_selective_indexes():
+    persistent.connect(debug=True)
+    d = D()
+    d.price = 1.0
+    d.sku = 's1'
+    d.save()
+    q = persistent.Query(D)
+    q.equal_to('id', d.id)
+    q.ascending('price')
+    assert any('id_index' in detail for detail in q.explain())
+    persistent.add_index(['sku'], unique=True)
+    q = persistent.Query(D)
+    q.equal_to('sku', 's1')
+    assert any('sku' in detail and 'type_index' not in detail
+               for detail in q.explain())
+    q = persistent.Query(D)
+    q.greater_than('price', 0.5)
+    assert any('tests_D__price__float__idx' in detail
+               for detail in q.explain())
+    k = K()
+    k.status = 'done'
+    k.due = datetime(2020, 1, 1)
+    k.save()
+    q = persistent.Query(K)
+    q.greater_than('due', datetime(2019, 1, 1))
+    assert not any('tests_K__due__epoch__idx' in detail
+                   for detail in q.explain())
+    assert q.first().id == k.id
+
+
+def test_reconcile_replaces_unscoped_index(tmpdir):
+    path = str(tmpdir.join('db.sqlite3'))
+    persistent.connect(db_path=path)
+    connection = persistent.database.connection
+    connection.execute('DROP INDEX tests_J__n__int__idx')
+    connection.execute(
+        "CREATE INDEX tests_J__n__int__idx "
+        "ON objects (json_extract(json, '$.py/object'), n__int)")
+    persistent.connect(db_path=path)
+    sql = persistent.database.connection.execute(
+        "SELECT sql FROM sqlite_master WHERE name='tests_J__n__int__idx'"
+        ).fetchone()[0]
+    assert 'WHERE' in sql
+
+
+def test_time_series():
+    persistent.connect(debug=True)
+    with persistent.transaction():
+        for day in range(90):
+            event = L()
+            event.at = datetime(2020, 1, 1) + timedelta(days=day)
+            event.message = 'day %d' % day
+            event.save(use_transaction=False)
+    q = persistent.Query(L)
+    q.between('at', datetime(2020, 2, 1), datetime(2020, 3, 1))
+    assert q.count() == 29
+    assert any('tests_L__at__epoch__idx' in detail
+               for detail in q.explain())
+    assert persistent.partitions(L) == [
+        ('2020-01', 31), ('2020-02', 29), ('2020-03', 30)]
+    assert persistent.drop_partitions(L, datetime(2020, 3, 15),
+                                      batch_size=7) == 60
+    assert persistent.partitions(L) == [('2020-03', 30)]
+    assert persistent.Query(L).count() == 30
+    assert persistent.Query(L).search('day').count() == 30
+    assert [c.op for c in persistent.changes_since(0)].count('delete') == 60
+
+
+def test_to_numpy():
+    numpy = pytest.importorskip('numpy')
+    persistent.connect(debug=True)
+    with persistent.transaction():
+        for i in range(25):
+            d = D()
+            d.price = i / 2
+            d.qty = i
+            d.name = 'd%d' % i
+            if i == 3:
+                del d.qty
+            d.save(use_transaction=False)
+    q = persistent.Query(D)
+    q.greater_than('price', 1)
+    q.ascending('price')
+    arrays = q.to_numpy({ 'price': 'f8', 'qty': 'i4', 'name': 'U8' },
+                        chunk_size=4)
+    assert arrays['price'].dtype == numpy.float64
+    assert list(arrays['price'][:2]) == [1.5, 2.0]
+    assert list(arrays['qty'][:2]) == [0, 4]
+    assert arrays['name'][-1] == 'd24'
+    assert len(arrays['qty']) == 22
+    q.limit(5)
+    assert len(q.to_numpy({ 'qty': 'f8' })['qty']) == 5
+    q = persistent.Query(D)
+    q.greater_than('price', 2)
+    q.ascending('price')
+    q.skip(2)
+    assert q.count() == 20
+    arrays = q.to_numpy({ 'price': 'f8' })
+    assert list(arrays['price'][:2]) == [3.5, 4.0]
+    assert len(arrays['price']) == 18
+    q.limit(30)
+    assert len(q.to_numpy({ 'price': 'f8' })['price']) == 18
+    q.skip(25)
+    assert len(q.to_numpy({ 'price': 'f8' })['price']) == 0
+
+
+def test_to_numpy_requires_numpy(monkeypatch):
+    import persistent.columns
+    monkeypatch.setattr(persistent.columns, 'numpy', None)
+    persistent.connect(debug=True)
+    with pytest.raises(ImportError):
+        persistent.Query(D).to_numpy({ 'price': 'f8' })
+
+
+def test_lazy_imports():
+    output = subprocess.run([sys.executable, '-c',
+        'import sys, persistent; '
+        'print(" ".join(m for m in ("jsonpickle", "ujson", "keypath", '
+        '"isodatetimehandler", "numpy") if m in sys.modules))'],
+        check=True, capture_output=True, text=True).stdout
+    assert output.split() == []
+
+
+def test_time_ordered_ids():
+    ids = [persistent.time_ordered_id() for i in range(10000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all(len(i) == 26 for i in ids)
+    assert abs(persistent.id_time(ids[0]) - time.time()) < 5
+
+
+def test_time_id_range():
+    persistent.connect(debug=True)
+    old = A()
+    old.save()
+    since = datetime.utcnow() + timedelta(milliseconds=5)
+    assert persistent.time_id(since) > old.id
+    time.sleep(0.01)
+    new = A()
+    new.save()
+    q = persistent.Query(A).greater_than_or_equal_to(
+        'id', persistent.time_id(since))
+    assert [o.id for o in q.find()] == [new.id]
+
+
+def test_id_generator():
+    counter = iter(range(100))
+    persistent.connect(debug=True, id_generator=lambda: 'a%d' % next(counter))
+    a = A()
+    a.save()
+    assert a.id == 'a0'
+    assert persistent.get('a0').id == 'a0'
+    persistent.connect(debug=True)
+    assert len(A().id) == 26
+
+
+def test_datetime_index_microseconds():
+    persistent.connect(debug=True)
+    t = datetime(2024, 5, 1, 12, 0, 0, 123456)
+    for cls in (L, A):
+        obj = cls()
+        obj.at = t
+        obj.save()
+    for cls in (L, A):
+        assert persistent.Query(cls).equal_to('at', t).count() == 1
+        assert persistent.Query(cls).greater_than_or_equal_to(
+            'at', t).count() == 1
+        assert persistent.Query(cls).greater_than(
+            'at', t - timedelta(microseconds=1)).count() == 1
+        assert persistent.Query(cls).greater_than('at', t).count() == 0
+        assert persistent.Query(cls).between(
+            'at', t, t + timedelta(microseconds=1)).count() == 1
+
+
+def test_full_text_fields_changed(tmpdir):
+    path = str(tmpdir.join('db.sqlite3'))
+    E.full_text = [ 'title' ]
+    try:
+        persistent.connect(db_path=path)
+        e = E()
+        e.title = 'hello'
+        e.body = 'world'
+        e.save()
+    finally:
+        E.full_text = [ 'title', 'body' ]
+    persistent.connect(db_path=path)
+    assert persistent.Query(E).search('world').first().id == e.id
+    e.body = 'planet'
+    e.save()
+    assert persistent.Query(E).search('planet').first().id == e.id
+    E.full_text = None
+    try:
+        persistent.connect(db_path=path)
+        assert not persistent.database.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='tests_E__fts'"
+            ).fetchone()
+    finally:
+        E.full_text = [ 'title', 'body' ]
+
+
+def test_import_duplicates():
+    import io
+    import persistent.tools
+    persistent.connect(debug=True)
+    j = J()
+    j.a = 1
+    j.b = { 'c': 2 }
+    j.save()
+    out = io.StringIO()
+    persistent.tools.export_jsonl(out)
+    duplicate = out.getvalue().strip().replace(j.id, 'other')
+    unique = duplicate.replace('other', 'third').replace('"a":1', '"a":3')
+    with pytest.raises(sqlite3.IntegrityError):
+        persistent.tools.import_jsonl([unique, duplicate], batch_size=1)
+    assert persistent.database.connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='tests_J__a__b_c__uniq'"
+        ).fetchone()
+    assert persistent.Query(J).count() == 2
+    assert persistent.Query(J).equal_to('a', 3).first().id == 'third'
+
+
+def test_compressed_partial_index():
+    G.indexes = [ persistent.Index('n', type=int),
+                  persistent.Index('due', type=datetime,
+                                   where={ 'status': 'active' }) ]
+    try:
+        persistent.connect(debug=True)
+        g = G()
+        g.status = 'active'
+        g.due = datetime(2020, 1, 2)
+        g.save()
+        q = persistent.Query(G)
+        q.equal_to('status', 'active')
+        q.greater_than('due', datetime(2020, 1, 1))
+        assert q.count() == 1
+        assert any('tests_G__due__epoch__idx' in detail
+                   for detail in q.explain())
+    finally:
+        G.indexes = [ persistent.Index('n', type=int) ]